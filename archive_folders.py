@@ -0,0 +1,28 @@
+"""
+The weekly folders emailcleanup.py archives the inbox to, named INBOX.<year>.<week - 1>-<week>.
+
+No side effects, so the date arithmetic can be tried out without a mailbox.
+"""
+from datetime import date
+import re
+
+WEEK_FOLDER = re.compile(r'^INBOX\.(\d{4})\.\d+-(\d+)$')
+
+def folder_week_start(year, week):
+    """
+    Monday of the week a weekly folder was made for, or None for a week that does not exist.
+    Older folders carry the calendar year rather than the ISO year, which differ around New Year;
+    the latest week the name can stand for is taken, so a folder is never pruned too early.
+    """
+    candidates = [(year, week)]
+    if week == 1:
+        candidates.append((year + 1, week))
+    if week >= 52:
+        candidates.append((year - 1, week))
+    starts = []
+    for candidate_year, candidate_week in candidates:
+        try:
+            starts.append(date.fromisocalendar(candidate_year, candidate_week, 1))
+        except ValueError:
+            pass
+    return max(starts, default=None)
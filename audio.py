@@ -0,0 +1,70 @@
+"""
+In-memory decoding of voicemail attachments to the PCM the speech API gets.
+
+Plain PCM WAV, which is what the PBX normally sends, is read here without ffmpeg or
+copying the samples. Anything else is handed to pydub (and so ffmpeg), as is the
+optional transcoding to OGG/Opus for Telegram.
+"""
+import io
+import struct
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def parse_wav(data):
+    """
+    Locate the samples of a PCM WAV file. Returns (pcm, sample_rate, channels, sample_width),
+    with pcm a memoryview into data, or None when data is not plain PCM WAV.
+    """
+    view = memoryview(data)
+    if len(view) < 12 or view[0:4] != b'RIFF' or view[8:12] != b'WAVE':
+        return None
+
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(view):
+        chunk_id = view[pos:pos + 4].tobytes()
+        size, = struct.unpack_from('<I', view, pos + 4)
+        body = pos + 8
+        if chunk_id == b'fmt ':
+            if size < 16:
+                return None
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack_from('<HHIIHH', view, body)
+            if audio_format == WAVE_FORMAT_EXTENSIBLE and size >= 26:
+                audio_format, = struct.unpack_from('<H', view, body + 24)
+            if audio_format != WAVE_FORMAT_PCM or bits % 8 or not channels:
+                return None
+            fmt = (sample_rate, channels, bits // 8)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            # Writers that stream the file leave the size open or wrong
+            end = min(body + size, len(view))
+            frame = fmt[1] * fmt[2]
+            end -= (end - body) % frame
+            return (view[body:end],) + fmt
+        pos = body + size + (size & 1)
+    return None
+
+def _audio_segment(data, wav):
+    from pydub import AudioSegment
+    if wav is not None:
+        pcm, rate, channels, sample_width = wav
+        return AudioSegment(data=pcm.tobytes(), sample_width=sample_width, frame_rate=rate, channels=channels)
+    return AudioSegment.from_file(io.BytesIO(data))
+
+def decode_audio(data, sample_rate):
+    """Decode an audio attachment to 16-bit mono PCM at sample_rate."""
+    wav = parse_wav(data)
+    if wav is not None:
+        pcm, rate, channels, sample_width = wav
+        if (rate, channels, sample_width) == (sample_rate, 1, 2):
+            return pcm
+    audio = _audio_segment(data, wav)
+    return audio.set_channels(1).set_sample_width(2).set_frame_rate(sample_rate).raw_data
+
+def encode_opus(data, bitrate="24k"):
+    """Transcode an audio attachment to OGG/Opus, Telegram's native voice format. Needs ffmpeg."""
+    out = io.BytesIO()
+    _audio_segment(data, parse_wav(data)).export(out, format="ogg", codec="libopus", bitrate=bitrate)
+    return out.getvalue()
@@ -0,0 +1,348 @@
+"""
+Offline end-to-end benchmark of main.py.
+
+A synthetic corpus of PBX voicemail mails is served from a local IMAP server (imap_server.py),
+and speech.SpeechClient and telegram.Bot are replaced by fakes with configurable latency and
+error rates. main_async() then runs unchanged against them and the run is summarised as
+throughput, latency to the voice message and to the complete transcript, API calls per
+message and peak memory.
+
+    python bench/benchmark.py --messages 50 --speech-latency 1.5 --speech-errors 0.05
+"""
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from pathlib import Path
+import argparse
+import array
+import asyncio
+import imaplib
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types
+import wave
+
+from imap_server import IMAPServer, Mailbox
+
+SAMPLE_RATE = 8000
+_ID = re.compile(r"#(\d+)")
+
+def _pcm(seconds, speaking):
+    if not speaking:
+        return bytes(int(seconds * SAMPLE_RATE) * 2)
+    samples = array.array('h', (int(6000 * math.sin(i * 0.3) * math.sin(i * 0.0021)) for i in range(int(seconds * SAMPLE_RATE))))
+    return samples.tobytes()
+
+def synthetic_wav(duration, rng):
+    """Speech-like bursts of a few seconds separated by short pauses, as 8 kHz mono PCM WAV."""
+    chunks = []
+    remaining = duration
+    while remaining > 0:
+        speech = min(remaining, rng.uniform(2, 9))
+        chunks.append(_pcm(speech, True))
+        remaining -= speech
+        pause = min(remaining, rng.uniform(0.3, 1.2))
+        chunks.append(_pcm(pause, False))
+        remaining -= pause
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes(b''.join(chunks))
+    return buffer.getvalue()
+
+def voicemail_mail(number, duration, rng, audio=None):
+    msg = MIMEMultipart()
+    msg['Subject'] = f"PBX: Nieuwe voicemail van 06{rng.randrange(10**8):08d} (#{number})"
+    msg['From'] = "pbx@example.com"
+    msg['To'] = "storing@example.com"
+    msg.attach(MIMEText(f"Er is een nieuwe voicemail van {duration:.0f} seconden in mailbox 9001.", 'plain', 'utf-8'))
+    part = MIMEApplication(audio or synthetic_wav(duration, rng), 'x-wav', name=f"msg{number:04d}.wav")
+    part.replace_header('Content-Type', f'audio/x-wav; name="msg{number:04d}.wav"')
+    part.add_header('Content-Disposition', 'attachment', filename=f"msg{number:04d}.wav")
+    msg.attach(part)
+    return msg.as_bytes()
+
+def corpus(count, min_duration, max_duration, duplicates, seed):
+    """Yield (number, duration, raw mail). A fraction of the mails repeats an earlier recording."""
+    rng = random.Random(seed)
+    recordings = []
+    for number in range(1, count + 1):
+        if recordings and rng.random() < duplicates:
+            duration, audio = rng.choice(recordings)
+        else:
+            duration = rng.uniform(min_duration, max_duration)
+            audio = synthetic_wav(duration, rng)
+            recordings.append((duration, audio))
+        yield number, duration, voicemail_mail(number, duration, rng, audio)
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.speech_calls = 0
+        self.speech_errors = 0
+        self.telegram_calls = 0
+        self.telegram_errors = 0
+        self.uploaded_bytes = 0
+        self.added = {}
+        # number -> first voice message, and last update of its transcript
+        self.delivered = {}
+        self.completed = {}
+        # Telegram message_id -> number
+        self.numbers = {}
+
+stats = Stats()
+
+class FakeOperation:
+    def __init__(self, transcript, latency, fail):
+        self.transcript = transcript
+        self.latency = latency
+        self.fail = fail
+
+    def result(self, timeout=None):
+        # The real client blocks here as well
+        time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("injected recognition failure")
+        alternative = types.SimpleNamespace(transcript=self.transcript)
+        return types.SimpleNamespace(results=[types.SimpleNamespace(alternatives=[alternative])])
+
+class FakeSpeechClient:
+    latency = 1.0
+    jitter = 0.5
+    error_rate = 0.0
+
+    def __init__(self, *args, **kwargs):
+        self.rng = random.Random()
+
+    def recognize(self, config=None, audio=None, timeout=None):
+        return self.long_running_recognize(config, audio).result(timeout)
+
+    def long_running_recognize(self, config=None, audio=None):
+        seconds = len(audio.content) / (2 * config.sample_rate_hertz)
+        with stats.lock:
+            stats.speech_calls += 1
+            fail = self.rng.random() < self.error_rate
+            stats.speech_errors += fail
+        latency = self.latency * (1 + seconds / 60) + self.rng.uniform(0, self.jitter)
+        words = " ".join(f"woord{i}" for i in range(int(seconds * 2)))
+        return FakeOperation(words, latency, fail)
+
+class FakeBot:
+    latency = 0.2
+    error_rate = 0.0
+    rng = random.Random()
+
+    def __init__(self, token=None, **kwargs):
+        self.token = token
+
+    async def _call(self, size, text, updates=None):
+        from telegram.error import NetworkError
+        with stats.lock:
+            stats.telegram_calls += 1
+            fail = self.rng.random() < self.error_rate
+            stats.telegram_errors += fail
+            stats.uploaded_bytes += size
+        await asyncio.sleep(self.latency)
+        if fail:
+            raise NetworkError("injected network failure")
+        message_id = stats.telegram_calls
+        match = _ID.search(text or "")
+        if match and updates is None:
+            stats.delivered.setdefault(int(match.group(1)), time.monotonic())
+            stats.numbers[message_id] = int(match.group(1))
+        if updates in stats.numbers:
+            stats.completed[stats.numbers[updates]] = time.monotonic()
+        attachment = types.SimpleNamespace(file_id=f"file{message_id}")
+        return types.SimpleNamespace(message_id=message_id, voice=attachment, audio=None, document=None)
+
+    async def send_voice(self, chat_id, voice, caption=None, **kwargs):
+        content = getattr(voice, 'input_file_content', b'')
+        return await self._call(len(content), caption)
+
+    async def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+        return await self._call(0, text, reply_to_message_id)
+
+    async def edit_message_caption(self, chat_id, message_id, caption=None, **kwargs):
+        return await self._call(0, caption, message_id)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return await self._call(0, text, message_id)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        return await self._call(0, None, message_id)
+
+class PlainIMAP(imaplib.IMAP4):
+    """The local server speaks plain IMAP; main.py asks for IMAP4_SSL."""
+    def __init__(self, host='', port=imaplib.IMAP4_PORT, **kwargs):
+        super().__init__(host, port)
+
+def write_config(directory, ports, args):
+    config_dir = directory / 'config'
+    config_dir.mkdir()
+    # More than one mailbox is configured in [mailbox:...] sections, one chat each
+    mailboxes = "".join(f"""
+[mailbox:bench{i}]
+IMAPSERVER = 127.0.0.1
+IMAPPORT = {port}
+EMAIL = bench{i}@example.com
+PASSWORD = bench
+CHATID = -{i + 1}
+""" for i, port in enumerate(ports)) if len(ports) > 1 else ""
+    (config_dir / 'config.ini').write_text(f"""[secrets]
+IMAPSERVER = 127.0.0.1
+IMAPPORT = {ports[0]}
+EMAIL = bench@example.com
+PASSWORD = bench
+TELEGRAMTOKEN = 123:bench
+CHATID = -1
+
+[settings]
+USEIDLE = {'yes' if args.idle else 'no'}
+POLLINTERVAL = 1
+TRANSCRIBECONCURRENCY = {args.transcribe_concurrency}
+CACHEENABLED = {'yes' if args.cache else 'no'}
+TELEGRAMGROUPRATE = {args.group_rate}
+{mailboxes}""")
+    (config_dir / 'googlekey.json').write_text('{}')
+    return config_dir
+
+def install_fakes(args):
+    from google.cloud import speech_v1p1beta1
+    from google.oauth2 import service_account
+    import telegram
+    FakeSpeechClient.latency = args.speech_latency
+    FakeSpeechClient.error_rate = args.speech_errors
+    FakeBot.latency = args.telegram_latency
+    FakeBot.error_rate = args.telegram_errors
+    speech_v1p1beta1.SpeechClient = FakeSpeechClient
+    service_account.Credentials.from_service_account_file = staticmethod(lambda *a, **k: None)
+    telegram.Bot = FakeBot
+    imaplib.IMAP4_SSL = PlainIMAP
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+async def run(args, mailboxes, messages):
+    import main
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.monotonic()
+    task = asyncio.create_task(main.main_async())
+    if args.rate:
+        for number, _, raw in messages:
+            stats.added[number] = time.monotonic()
+            mailboxes[number % len(mailboxes)].append(raw)
+            await asyncio.sleep(1 / args.rate)
+
+    deadline = time.monotonic() + args.timeout
+    while len(stats.delivered) < len(stats.added) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    # Then wait for the transcripts to be filled in
+    while (any(main.message_ledger.pending(configured.key, 1) for configured in main.MAILBOXES)
+           and time.monotonic() < deadline):
+        await asyncio.sleep(0.05)
+    finished = time.monotonic()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return started, finished
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--min-duration', type=float, default=5, help='seconds of audio per voicemail')
+    parser.add_argument('--max-duration', type=float, default=150)
+    parser.add_argument('--duplicates', type=float, default=0.0, help='fraction of repeated recordings')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='mails per second arriving during the run; 0 puts them all in the inbox before the start')
+    parser.add_argument('--speech-latency', type=float, default=1.0, help='seconds per 60 s segment')
+    parser.add_argument('--speech-errors', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.2)
+    parser.add_argument('--telegram-errors', type=float, default=0.0)
+    parser.add_argument('--group-rate', type=float, default=6000,
+                        help="messages per minute to the chat; Telegram's own limit for a group is 20")
+    parser.add_argument('--transcribe-concurrency', type=int, default=4)
+    parser.add_argument('--mailboxes', type=int, default=1,
+                        help='mailboxes to spread the corpus over, each on its own IMAP server and chat')
+    parser.add_argument('--no-idle', dest='idle', action='store_false')
+    parser.add_argument('--no-cache', dest='cache', action='store_false')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--verbose', action='store_true', help="keep main.py's logging")
+    args = parser.parse_args()
+
+    mailboxes = [Mailbox() for _ in range(args.mailboxes)]
+    servers = [IMAPServer(mailbox, idle=args.idle) for mailbox in mailboxes]
+    ports = [server.start() for server in servers]
+    messages = list(corpus(args.messages, args.min_duration, args.max_duration, args.duplicates, args.seed))
+    corpus_bytes = sum(len(raw) for _, _, raw in messages)
+    if not args.rate:
+        for number, _, raw in messages:
+            stats.added[number] = time.monotonic()
+            mailboxes[number % len(mailboxes)].append(raw)
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        os.environ['VOICEMAIL_CONFIG_DIR'] = str(write_config(directory, ports, args))
+        os.environ['VOICEMAIL_DATA_DIR'] = str(directory / 'data')
+        # Keep the injected failures out of the real log
+        os.environ['VOICEMAIL_LOG_DIR'] = str(directory / 'logs')
+        sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+        install_fakes(args)
+        started, finished = asyncio.run(run(args, mailboxes, messages))
+
+    latencies = [stats.delivered[n] - stats.added[n] for n in stats.delivered]
+    transcript_latencies = [stats.completed[n] - stats.added[n] for n in stats.completed]
+    delivered = len(stats.delivered)
+    results = {
+        'messages': len(messages),
+        'delivered': delivered,
+        'audio_seconds': round(sum(duration for _, duration, _ in messages), 1),
+        'corpus_mb': round(corpus_bytes / 1e6, 2),
+        'elapsed_s': round(finished - started, 2),
+        'messages_per_s': round(delivered / (finished - started), 3) if delivered else 0,
+        'latency_p50_s': round(percentile(latencies, 50), 2),
+        'latency_p95_s': round(percentile(latencies, 95), 2),
+        'latency_p99_s': round(percentile(latencies, 99), 2),
+        'transcript_p50_s': round(percentile(transcript_latencies, 50), 2),
+        'transcript_p95_s': round(percentile(transcript_latencies, 95), 2),
+        'speech_calls_per_message': round(stats.speech_calls / max(delivered, 1), 2),
+        'speech_errors': stats.speech_errors,
+        'telegram_calls_per_message': round(stats.telegram_calls / max(delivered, 1), 2),
+        'telegram_errors': stats.telegram_errors,
+        'telegram_upload_mb': round(stats.uploaded_bytes / 1e6, 2),
+        'imap_commands_per_message': round(sum(server.commands for server in servers) / max(delivered, 1), 2),
+        'imap_mb_sent': round(sum(server.bytes_sent for server in servers) / 1e6, 2),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    for server in servers:
+        server.shutdown()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        width = max(len(key) for key in results)
+        for key, value in results.items():
+            print(f"{key:<{width}}  {value}")
+    if delivered < len(messages):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+A small in-process IMAP server for the benchmark.
+
+It understands just the part of IMAP4rev1 that main.py uses: LOGIN, SELECT, UID SEARCH,
+UID FETCH (INTERNALDATE, BODYSTRUCTURE, header fields and body sections), UID STORE and IDLE. Mail is
+kept in memory and can be added while clients are connected; idling clients are told
+right away, like a real server would.
+"""
+import email
+import imaplib
+import re
+import select
+import socketserver
+import threading
+import time
+
+_TOKEN = re.compile(rb'"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()\[]+(?:\[[^\]]*\][^\s()]*)?)')
+
+class Mailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []  # dicts with uid, raw, msg, flags, added
+        self.changed = threading.Condition()
+
+    def append(self, raw, flags=()):
+        with self.changed:
+            uid = self.uidnext
+            self.uidnext += 1
+            self.messages.append({
+                'uid': uid,
+                'raw': raw,
+                'msg': email.message_from_bytes(raw),
+                'flags': set(flags),
+                'added': time.monotonic(),
+                'received': time.time(),
+            })
+            self.changed.notify_all()
+            return uid
+
+    def by_uid(self, uid):
+        for seq, message in enumerate(self.messages, start=1):
+            if message['uid'] == uid:
+                return seq, message
+        return None, None
+
+def _tokens(text):
+    tokens = []
+    for quoted, open_, close, atom in _TOKEN.findall(text):
+        if open_:
+            tokens.append('(')
+        elif close:
+            tokens.append(')')
+        elif atom:
+            tokens.append(atom.decode())
+        else:
+            tokens.append(quoted.decode())
+    return tokens
+
+def _uid_set(spec, highest):
+    uids = set()
+    for item in spec.split(','):
+        if ':' in item:
+            low, high = item.split(':')
+            low = highest if low == '*' else int(low)
+            high = highest if high == '*' else int(high)
+            uids.update(range(min(low, high), max(low, high) + 1))
+        else:
+            uids.add(highest if item == '*' else int(item))
+    return uids
+
+def _quote(value):
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _params(pairs):
+    pairs = [(key, value) for key, value in pairs if value is not None]
+    if not pairs:
+        return 'NIL'
+    return '(' + ' '.join(f'{_quote(key.upper())} {_quote(value)}' for key, value in pairs) + ')'
+
+def bodystructure(part):
+    if part.is_multipart():
+        children = ''.join(bodystructure(child) for child in part.get_payload())
+        return f'({children} {_quote(part.get_content_subtype().upper())} {_params([("boundary", part.get_boundary())])} NIL NIL)'
+    maintype, subtype = part.get_content_maintype().upper(), part.get_content_subtype().upper()
+    body = part.get_payload().encode()
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').upper()
+    params = _params([('charset', part.get_param('charset')), ('name', part.get_param('name'))])
+    fields = f'{_quote(maintype)} {_quote(subtype)} {params} NIL NIL {_quote(encoding)} {len(body)}'
+    if maintype == 'TEXT':
+        lines = body.count(b'\n')
+        return f'({fields} {lines} NIL NIL NIL)'
+    filename = part.get_filename()
+    disposition = f'("ATTACHMENT" {_params([("filename", filename)])})' if filename else 'NIL'
+    return f'({fields} NIL {disposition} NIL)'
+
+def _section(msg, raw, spec):
+    if spec == '':
+        return raw
+    if spec.upper().startswith('HEADER.FIELDS'):
+        names = [name.lower() for name in re.findall(r'[\w-]+', spec[len('HEADER.FIELDS'):])]
+        lines = [f'{name}: {value}' for name, value in msg.items() if name.lower() in names]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+    part = msg
+    for number in spec.split('.'):
+        part = part.get_payload()[int(number) - 1] if part.is_multipart() else part
+    return part.get_payload().encode()
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send(b'* OK IMAP4rev1 benchmark server ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            self.server.commands += 1
+            tokens = _tokens(line.rstrip(b'\r\n'))
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            if command == 'UID':
+                command, args = 'UID ' + args[0].upper(), args[1:]
+            handler = getattr(self, 'do_' + command.replace(' ', '_'), None)
+            if handler is None:
+                self.send(f'{tag} BAD unknown command\r\n'.encode())
+                continue
+            if handler(tag, args, mailbox) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args, mailbox):
+        self.send(f'* CAPABILITY IMAP4rev1 {"IDLE" if self.server.idle else ""}\r\n{tag} OK done\r\n'.encode())
+
+    def do_LOGIN(self, tag, args, mailbox):
+        self.send(f'{tag} OK logged in\r\n'.encode())
+
+    def do_NOOP(self, tag, args, mailbox):
+        self.send(f'{tag} OK done\r\n'.encode())
+
+    def do_LOGOUT(self, tag, args, mailbox):
+        self.send(f'* BYE\r\n{tag} OK done\r\n'.encode())
+        return False
+
+    def do_SELECT(self, tag, args, mailbox):
+        with mailbox.changed:
+            self.send((f'* {len(mailbox.messages)} EXISTS\r\n* 0 RECENT\r\n'
+                       f'* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n'
+                       f'* OK [UIDNEXT {mailbox.uidnext}] next UID\r\n'
+                       f'{tag} OK [READ-WRITE] selected\r\n').encode())
+    do_EXAMINE = do_SELECT
+
+    def do_UID_SEARCH(self, tag, args, mailbox):
+        with mailbox.changed:
+            messages = list(mailbox.messages)
+        highest = messages[-1]['uid'] if messages else 0
+        matches = []
+        for message in messages:
+            i, ok = 0, True
+            while i < len(args):
+                key = args[i].upper()
+                if key == 'UNSEEN':
+                    ok &= '\\Seen' not in message['flags']
+                elif key == 'SEEN':
+                    ok &= '\\Seen' in message['flags']
+                elif key == 'SUBJECT':
+                    i += 1
+                    ok &= args[i].lower() in (message['msg']['subject'] or '').lower()
+                elif key == 'UID':
+                    i += 1
+                    ok &= message['uid'] in _uid_set(args[i], highest)
+                i += 1
+            if ok:
+                matches.append(str(message['uid']))
+        self.send(f'* SEARCH {" ".join(matches)}\r\n{tag} OK done\r\n'.encode())
+
+    def do_UID_FETCH(self, tag, args, mailbox):
+        with mailbox.changed:
+            highest = mailbox.messages[-1]['uid'] if mailbox.messages else 0
+        items = [item for item in args[1:] if item not in ('(', ')')]
+        for uid in sorted(_uid_set(args[0], highest)):
+            seq, message = mailbox.by_uid(uid)
+            if message is None:
+                continue
+            out = [f'* {seq} FETCH (UID {uid}'.encode()]
+            for item in items:
+                name = item.upper()
+                if name == 'UID':
+                    continue
+                if name == 'INTERNALDATE':
+                    out.append(f' INTERNALDATE {imaplib.Time2Internaldate(message["received"])}'.encode())
+                elif name == 'FLAGS':
+                    out.append(f' FLAGS ({" ".join(message["flags"])})'.encode())
+                elif name == 'BODYSTRUCTURE':
+                    out.append(b' BODYSTRUCTURE ' + bodystructure(message['msg']).encode())
+                elif name.startswith(('BODY[', 'BODY.PEEK[', 'RFC822')):
+                    spec = item[item.index('[') + 1:item.rindex(']')] if '[' in item else ''
+                    if not name.startswith('BODY.PEEK'):
+                        message['flags'].add('\\Seen')
+                    data = _section(message['msg'], message['raw'], spec)
+                    label = 'RFC822' if name == 'RFC822' else f'BODY[{spec}]'
+                    out.append(f' {label} {{{len(data)}}}\r\n'.encode() + data)
+            out.append(b')\r\n')
+            self.send(b''.join(out))
+            self.server.bytes_sent += sum(len(chunk) for chunk in out)
+        self.send(f'{tag} OK done\r\n'.encode())
+
+    def do_UID_STORE(self, tag, args, mailbox):
+        with mailbox.changed:
+            highest = mailbox.messages[-1]['uid'] if mailbox.messages else 0
+        flags = [flag for flag in args[2:] if flag not in ('(', ')')]
+        for uid in _uid_set(args[0], highest):
+            _, message = mailbox.by_uid(uid)
+            if message is not None:
+                if args[1].upper().startswith('+'):
+                    message['flags'].update(flags)
+                else:
+                    message['flags'].difference_update(flags)
+        self.send(f'{tag} OK done\r\n'.encode())
+
+    def do_IDLE(self, tag, args, mailbox):
+        with mailbox.changed:
+            known = len(mailbox.messages)
+        self.send(b'+ idling\r\n')
+        while True:
+            with mailbox.changed:
+                mailbox.changed.wait(0.05)
+                count = len(mailbox.messages)
+            if count != known:
+                known = count
+                self.send(f'* {count} EXISTS\r\n'.encode())
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                self.send(f'{tag} OK idle done\r\n'.encode())
+                return
+
+class IMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox, idle=True, address=('127.0.0.1', 0)):
+        super().__init__(address, IMAPHandler)
+        self.mailbox = mailbox
+        self.idle = idle
+        self.commands = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
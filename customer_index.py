@@ -0,0 +1,107 @@
+"""
+Config files kept in memory until they change on disk, and a search index over customers.json.
+
+customers.json maps a command name to the text the bot answers with. The index holds every
+word of the names and texts, sorted, so a query word is looked up by bisection as a prefix
+and only falls back to fuzzy matching (difflib) when no word starts with it.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import difflib
+import json
+import logging
+import os
+import re
+import unicodedata
+
+_WORD = re.compile(r"\w+")
+
+def normalize(text):
+    """Lower case without accents, so "Café" is found as "cafe"."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokens(text):
+    return _WORD.findall(normalize(text))
+
+class FileCache:
+    """The result of load(path), loaded again only when the file is replaced or modified."""
+    def __init__(self, path, load):
+        self.path = path
+        self.load = load
+        self.signature = None
+        self.value = None
+
+    def get(self):
+        stat = os.stat(self.path)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature != self.signature:
+            try:
+                self.value = self.load(self.path)
+            except Exception as e:
+                if self.signature is None:
+                    raise
+                # Keep answering from the last good version while the file is being edited
+                logging.error("Could not reload %s, keeping the previous version: %s", self.path, e)
+            else:
+                logging.info("Loaded %s", self.path)
+            self.signature = signature
+        return self.value
+
+class CustomerIndex:
+    # Words in the command name count more than words in the text
+    NAME_WEIGHT = 3
+    TEXT_WEIGHT = 1
+
+    def __init__(self, customers):
+        self.customers = customers
+        # word -> {command: weight}
+        self.postings = defaultdict(dict)
+        for command, text in customers.items():
+            for weight, words in ((self.TEXT_WEIGHT, tokens(text)), (self.NAME_WEIGHT, tokens(command.replace("_", " ")))):
+                for word in words:
+                    postings = self.postings[word]
+                    postings[command] = max(postings.get(command, 0), weight)
+        self.words = sorted(self.postings)
+        self.by_initial = defaultdict(list)
+        for word in self.words:
+            self.by_initial[word[0]].append(word)
+
+    def get(self, command):
+        return self.customers.get(command)
+
+    def _matches(self, word):
+        """Index words matching word: (word, quality) with 3 exact, 2 prefix and 1 fuzzy."""
+        matches = []
+        i = bisect_left(self.words, word)
+        while i < len(self.words) and self.words[i].startswith(word):
+            matches.append((self.words[i], 3 if self.words[i] == word else 2))
+            i += 1
+        if not matches and len(word) >= 3:
+            # Typos rarely hit the first letter, which keeps the candidates few
+            close = difflib.get_close_matches(word, self.by_initial.get(word[0], []), n=5, cutoff=0.75)
+            matches = [(candidate, 1) for candidate in close]
+        return matches
+
+    def search(self, query, limit=10):
+        """Commands best matching query, best first. Commands matching more of the query words rank higher."""
+        scores = defaultdict(int)
+        matched = defaultdict(int)
+        for word in set(tokens(query)):
+            best = {}
+            for candidate, quality in self._matches(word):
+                for command, weight in self.postings[candidate].items():
+                    best[command] = max(best.get(command, 0), quality * weight)
+            for command, score in best.items():
+                scores[command] += score
+                matched[command] += 1
+        ranked = sorted(scores, key=lambda command: (-matched[command], -scores[command], command))
+        return ranked[:limit]
+
+def load_customers(path):
+    with open(path, "r") as file:
+        return CustomerIndex(json.load(file))
+
+def load_text(path):
+    with open(path, "r") as file:
+        return file.read()
@@ -1,14 +1,19 @@
+import asyncio
 import schedule
 import time
 import imaplib
 import email
-import configparser
-from datetime import datetime
-from pathlib import Path
+import re
+from datetime import date, datetime, timedelta
 import logging
+import metrics
+import ledger
+from imap_fetch import uid_set
+from archive_folders import WEEK_FOLDER, folder_week_start
+import shared_config
 
 # Set up logging directory and file
-log_dir = Path(__file__).resolve().parent / 'logs'
+log_dir = shared_config.log_dir
 log_dir.mkdir(exist_ok=True)
 log_file = log_dir / 'email_cleanup.log'
 
@@ -22,66 +27,254 @@ logging.basicConfig(
     ]
 )
 
-config_dir = Path(__file__).resolve().parent / 'config'
-config_file = config_dir / 'config.ini'
-config = configparser.ConfigParser()
-config.read(config_file)
+config_dir = shared_config.config_dir
+data_dir = shared_config.data_dir
+data_dir.mkdir(exist_ok=True)
+config_file = shared_config.config_file
+config = shared_config.load_config()
 
 # Configuration for the email account and IMAP server
 imap_host = config['secrets']['IMAPSERVER']
 imap_user = config['secrets']['EMAIL']
 imap_pass = config['secrets']['PASSWORD']
 
+# Metrics are served two ports after main.py's, when METRICSPORT is set
+METRICS_PORT = config.getint('settings', 'METRICSPORT', fallback=0)
+METRICS_HOST = config.get('settings', 'METRICSHOST', fallback='127.0.0.1')
+
+imap_seconds = metrics.Histogram('cleanup_imap_seconds', 'IMAP operations of the weekly cleanup.', ['op'])
+moved_total = metrics.Counter('cleanup_moved_total', 'Emails moved out of the inbox.')
+runs_total = metrics.Counter('cleanup_runs_total', 'Cleanup runs.', ['outcome'])
+
+# How many emails to move per IMAP command
+MOVE_CHUNK = config.getint('settings', 'CLEANUPCHUNK', fallback=500)
+
+# Archival settings, all optional. Without ARCHIVEINTERVAL the whole inbox is archived every Friday.
+ARCHIVE_INTERVAL = config.getint('settings', 'ARCHIVEINTERVAL', fallback=0)
+ARCHIVE_AFTER_DAYS = config.getint('settings', 'ARCHIVEAFTERDAYS', fallback=1)
+if ARCHIVE_AFTER_DAYS < 1:
+    # Mail that just arrived may not have reached Telegram yet
+    raise ValueError(f"ARCHIVEAFTERDAYS must be at least 1, not {ARCHIVE_AFTER_DAYS}")
+ARCHIVE_WEEKS = config.getint('settings', 'ARCHIVEWEEKS', fallback=0)
+ARCHIVE_MAILBOX = f"{imap_user}@{imap_host}/INBOX"
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Highest archived UID per UIDVALIDITY, so incremental runs only look at newer mail
+archive_ledger = ledger.Ledger(data_dir / 'archive.db')
+# main.py's record of what it has delivered, so archiving never takes mail it still has to send
+delivery_ledger = ledger.Ledger(data_dir / 'ledger.db')
+# Folders known to exist, so they are only checked once
+known_folders = set()
+
 def get_current_week_range():
     current_week = datetime.now().isocalendar()
-    current_year = int(datetime.now().year)
-    folder_name = f"INBOX.{current_year}.{current_week[1] - 1}-{current_week[1]}"
+    # The ISO year the week belongs to, not the calendar year: on 31 December that may be next year's week 1
+    folder_name = f"INBOX.{current_week[0]}.{current_week[1] - 1}-{current_week[1]}"
     return folder_name, current_week[0]
 
-def process_emails():
-    try:
-        mail = imaplib.IMAP4_SSL(imap_host)
-        mail.login(imap_user, imap_pass)
-        mail.select('INBOX')
-
-        folder_name, _ = get_current_week_range()
-        status, folder_list = mail.list()
-
-        inbox_folder_name = f'{folder_name}'
-        if inbox_folder_name.encode() not in [f.split()[-1] for f in folder_list[1]]:
-            status, create_response = mail.create(inbox_folder_name)
-            if status != 'OK':
-                logging.error(f"Failed to create folder: {inbox_folder_name}, Status: {status}, Response: {create_response}")
-                mail.logout()
-                return
-            logging.info(f"Created folder: {inbox_folder_name}")
-
-        status, messages = mail.uid('search', None, 'ALL')
+def move_emails(mail, uids, folder, capabilities, on_moved=None):
+    """
+    Move the UIDs to folder in chunks of MOVE_CHUNK. Uses MOVE (RFC 6851) when the server has it,
+    otherwise COPY, STORE \\Deleted and UID EXPUNGE (RFC 4315) of just that chunk. Returns the
+    number of emails moved. With on_moved, it is called with every chunk moved and moving stops
+    at the first chunk that fails.
+    """
+    moved = 0
+    for start in range(0, len(uids), MOVE_CHUNK):
+        chunk = uids[start:start + MOVE_CHUNK]
+        uids_in_chunk = uid_set(chunk)
+        if 'MOVE' in capabilities:
+            with imap_seconds.time(op="move"):
+                status, response = mail.uid('MOVE', uids_in_chunk, f'"{folder}"')
+        else:
+            with imap_seconds.time(op="copy"):
+                status, response = mail.uid('COPY', uids_in_chunk, f'"{folder}"')
+            if status == 'OK':
+                with imap_seconds.time(op="store"):
+                    status, response = mail.uid('STORE', uids_in_chunk, '+FLAGS.SILENT', '(\\Deleted)')
+            if status == 'OK':
+                with imap_seconds.time(op="expunge"):
+                    if 'UIDPLUS' in capabilities:
+                        status, response = mail.uid('EXPUNGE', uids_in_chunk)
+                    else:
+                        status, response = mail.expunge()
         if status == 'OK':
-            messages = messages[0].split()
-            for mail_id in messages:
-                logging.info(f"Processing email with UID: {mail_id}")
-                status, move_response = mail.uid('COPY', mail_id, f'"{inbox_folder_name}"')
-                if status == 'OK':
-                    mail.uid('STORE', mail_id, '+FLAGS', '\\Deleted')
-                    logging.info(f"Moved email UID: {mail_id} to folder: {inbox_folder_name}")
-                else:
-                    logging.error(f"Failed to move email {mail_id} to folder {inbox_folder_name}, Status: {status}, Response: {move_response}")
-
-        mail.expunge()
-        logging.info("Expunged deleted emails from INBOX")
+            moved += len(chunk)
+            moved_total.inc(len(chunk))
+            logging.info(f"Moved {len(chunk)} emails (UIDs {uids_in_chunk}) to folder: {folder}")
+            if on_moved is not None:
+                on_moved(chunk)
+        else:
+            logging.error(f"Failed to move emails {uids_in_chunk} to folder {folder}, Status: {status}, Response: {response}")
+            if on_moved is not None:
+                break
+    return moved
+
+def folder_names(list_data):
+    """Folder names from LIST responses like (\\HasNoChildren) "." "INBOX.2026.40-41"."""
+    names = []
+    for line in list_data:
+        if not line:
+            continue
+        if isinstance(line, tuple):
+            # Names that need quoting may be sent as a literal
+            names.append(line[1].decode())
+            continue
+        name = re.match(rb'\(.*?\) (?:"(?:[^"\\]|\\.)*"|NIL) (.*)$', line).group(1).decode()
+        names.append(name[1:-1].replace('\\"', '"').replace('\\\\', '\\') if name.startswith('"') else name)
+    return names
+
+def ensure_folder(mail, folder):
+    """Create folder unless it exists. Returns False when it could not be created."""
+    if folder in known_folders:
+        return True
+    status, folder_list = mail.list('""', f'"{folder}"')
+    if status == 'OK' and folder in folder_names(folder_list):
+        known_folders.add(folder)
+        return True
+    status, create_response = mail.create(folder)
+    if status != 'OK':
+        logging.error(f"Failed to create folder: {folder}, Status: {status}, Response: {create_response}")
+        return False
+    logging.info(f"Created folder: {folder}")
+    known_folders.add(folder)
+    return True
+
+def search_uids(mail, criteria):
+    with imap_seconds.time(op="search"):
+        status, messages = mail.uid('search', None, criteria)
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"Search failed: {messages}")
+    return sorted(int(uid) for uid in messages[0].split())
+
+def archivable_uids(mail, uidvalidity):
+    """
+    UIDs above the checkpoint of mail at least ARCHIVE_AFTER_DAYS days old that main.py has delivered
+    or given up on. Only the UIDs up to the first mail that is too young or still to be delivered, so
+    the checkpoint never moves past mail that has not been archived.
+    """
+    checkpoint = archive_ledger.checkpoint(ARCHIVE_MAILBOX, uidvalidity) or 0
+    # SEARCH BEFORE has a resolution of days and wants English month names whatever the locale;
+    # BEFORE compares with the start of that day, so this is mail of ARCHIVE_AFTER_DAYS days or more
+    before = date.today() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    before = f"{before.day}-{MONTHS[before.month - 1]}-{before.year}"
+    newer = [uid for uid in search_uids(mail, f'UID {checkpoint + 1}:*') if uid > checkpoint]
+    old_enough = set(search_uids(mail, f'UID {checkpoint + 1}:* BEFORE {before}'))
+    # Without a checkpoint main.py does not watch this mailbox, or never got to it
+    delivered_up_to = delivery_ledger.checkpoint(ARCHIVE_MAILBOX, uidvalidity)
+    undelivered = set(delivery_ledger.pending(ARCHIVE_MAILBOX, uidvalidity))
+    uids = []
+    for uid in newer:
+        if uid not in old_enough or uid in undelivered or (delivered_up_to is not None and uid > delivered_up_to):
+            break
+        uids.append(uid)
+    return uids
+
+def process_emails(incremental=False):
+    """
+    Move the inbox to this week's folder. Incrementally only mail above the checkpoint is
+    moved, and the checkpoint is saved after every chunk, so an interrupted run resumes there.
+    """
+    try:
+        with imap_seconds.time(op="login"):
+            mail = imaplib.IMAP4_SSL(imap_host)
+            mail.login(imap_user, imap_pass)
+            mail.select('INBOX')
+        _, uidvalidity = mail.response('UIDVALIDITY')
+        uidvalidity = int(uidvalidity[0])
+
+        inbox_folder_name, _ = get_current_week_range()
+        if not ensure_folder(mail, inbox_folder_name):
+            mail.logout()
+            runs_total.inc(outcome="error")
+            return
+
+        # Servers often only advertise extensions after login, so ask again
+        status, capability = mail.capability()
+        capabilities = capability[0].decode().upper().split() if status == 'OK' else []
+
+        if incremental:
+            uids = archivable_uids(mail, uidvalidity)
+            checkpoint = lambda chunk: archive_ledger.add(ARCHIVE_MAILBOX, uidvalidity, [], max(chunk))
+            moved = move_emails(mail, uids, inbox_folder_name, capabilities, on_moved=checkpoint)
+        else:
+            uids = search_uids(mail, 'ALL')
+            moved = move_emails(mail, uids, inbox_folder_name, capabilities)
+        logging.info(f"Moved {moved} of {len(uids)} emails to folder: {inbox_folder_name}")
 
         mail.close()
         mail.logout()
+        runs_total.inc(outcome="ok")
     except Exception as e:
+        runs_total.inc(outcome="error")
         logging.error(f"An error occurred: {str(e)}")
 
+def prune_folders():
+    """Delete the weekly folders that are more than ARCHIVE_WEEKS weeks old."""
+    try:
+        with imap_seconds.time(op="login"):
+            mail = imaplib.IMAP4_SSL(imap_host)
+            mail.login(imap_user, imap_pass)
+        status, folder_list = mail.list('""', '"INBOX.*"')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"Listing folders failed: {folder_list}")
+        oldest = date.today() - timedelta(weeks=ARCHIVE_WEEKS)
+        today = datetime.now()
+        # This week's folder, also as it was named before the ISO year was used
+        current = {get_current_week_range()[0],
+                   f"INBOX.{today.year}.{today.isocalendar()[1] - 1}-{today.isocalendar()[1]}"}
+        for folder in folder_names(folder_list):
+            match = WEEK_FOLDER.match(folder)
+            if not match or folder in current:
+                continue
+            week_start = folder_week_start(int(match.group(1)), int(match.group(2)))
+            if week_start is None or week_start >= oldest:
+                continue
+            with imap_seconds.time(op="delete"):
+                status, response = mail.delete(f'"{folder}"')
+            if status == 'OK':
+                known_folders.discard(folder)
+                logging.info(f"Deleted folder older than {ARCHIVE_WEEKS} weeks: {folder}")
+            else:
+                logging.error(f"Failed to delete folder {folder}, Status: {status}, Response: {response}")
+        mail.logout()
+    except Exception as e:
+        logging.error(f"An error occurred while pruning folders: {str(e)}")
+
 def job():
     process_emails()
 
-# Schedule the job to run every Friday at 09:00
-schedule.every().friday.at("09:00").do(job)
+def incremental_job():
+    process_emails(incremental=True)
+
+# A scheduler of our own, so the jobs can share a process with other code
+scheduler = schedule.Scheduler()
+if ARCHIVE_INTERVAL:
+    # Archive mail that is old enough every ARCHIVEINTERVAL minutes
+    scheduler.every(ARCHIVE_INTERVAL).minutes.do(incremental_job)
+else:
+    # Schedule the job to run every Friday at 09:00
+    scheduler.every().friday.at("09:00").do(job)
+if ARCHIVE_WEEKS:
+    scheduler.every().day.at("03:00").do(prune_folders)
+
+async def run(stopping):
+    """Run the scheduled jobs until stopping is set. This is how the supervisor runs the cleanup."""
+    while not stopping.is_set():
+        # The jobs use blocking imaplib, keep them off the event loop
+        await asyncio.to_thread(scheduler.run_pending)
+        try:
+            await asyncio.wait_for(stopping.wait(), 10)
+        except asyncio.TimeoutError:
+            pass
+
+def main():
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT + 2, METRICS_HOST)
+
+    while True:
+        scheduler.run_pending()
+        time.sleep(10)
 
-while True:
-    schedule.run_pending()
-    time.sleep(10)
+if __name__ == "__main__":
+    main()
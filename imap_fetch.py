@@ -0,0 +1,241 @@
+"""
+Fetch only the parts of voicemail mails that are needed, for several mails per round-trip.
+
+The BODYSTRUCTURE of a batch is read first, then only the text and audio sections are
+downloaded with BODY.PEEK[n], which leaves \\Seen alone. The full message is never
+downloaded or parsed.
+"""
+from collections import defaultdict, namedtuple
+from email.header import decode_header, make_header
+import binascii
+import email
+import email.errors
+import email.utils
+import imaplib
+import quopri
+import time
+import urllib.parse
+
+# section is the IMAP part number ("1", "2.1"), content_type e.g. "audio/x-wav"
+Part = namedtuple('Part', ['section', 'content_type', 'charset', 'encoding', 'name'])
+
+# attachments is a list of (filename, audio bytes)
+# received: INTERNALDATE as a Unix timestamp, None if the server did not send it
+Voicemail = namedtuple('Voicemail', ['uid', 'subject', 'sender', 'text', 'attachments', 'received'])
+
+_OPEN = object()
+_CLOSE = object()
+
+def _quoted(text, i):
+    value = bytearray()
+    i += 1
+    while text[i] != ord('"'):
+        if text[i] == ord('\\'):
+            i += 1
+        value.append(text[i])
+        i += 1
+    return value.decode('utf-8', 'replace'), i + 1
+
+def _atom(text, i):
+    start = i
+    while i < len(text) and text[i] not in b' ()\r\n':
+        # Section specs like BODY[HEADER.FIELDS (SUBJECT)] contain spaces and parentheses
+        if text[i] == ord('['):
+            i = text.index(b']', i)
+        i += 1
+    atom = text[start:i].decode('ascii', 'replace')
+    return (None if atom.upper() == 'NIL' else atom), i
+
+def _tokenize(text, tokens):
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in b' \r\n':
+            i += 1
+        elif c == ord('('):
+            tokens.append(_OPEN)
+            i += 1
+        elif c == ord(')'):
+            tokens.append(_CLOSE)
+            i += 1
+        elif c == ord('"'):
+            value, i = _quoted(text, i)
+            tokens.append(value)
+        elif c == ord('{'):
+            # Literal marker; imaplib hands over the literal itself separately
+            i = text.index(b'}', i) + 1
+        else:
+            value, i = _atom(text, i)
+            tokens.append(value)
+
+def _tokens(data):
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            _tokenize(item[0], tokens)
+            tokens.append(item[1])
+        elif item:
+            _tokenize(item, tokens)
+    return tokens
+
+def _parse(tokens, i):
+    if tokens[i] is not _OPEN:
+        return tokens[i], i + 1
+    values = []
+    i += 1
+    while tokens[i] is not _CLOSE:
+        value, i = _parse(tokens, i)
+        values.append(value)
+    return values, i + 1
+
+def parse_fetch(data):
+    """Turn the data of a UID FETCH response into {uid: {item: value}}."""
+    tokens = _tokens(data)
+    messages = defaultdict(dict)
+    i = 0
+    while i < len(tokens):
+        # "<seq> FETCH (...)"; imaplib already strips the "FETCH"
+        _, i = _parse(tokens, i)
+        if i < len(tokens) and isinstance(tokens[i], str) and tokens[i].upper() == 'FETCH':
+            i += 1
+        values, i = _parse(tokens, i)
+        items = {str(values[j]).upper(): values[j + 1] for j in range(0, len(values) - 1, 2)}
+        # Unsolicited FETCH responses (flag changes) carry no UID
+        if 'UID' in items:
+            messages[int(items['UID'])].update(items)
+    return dict(messages)
+
+def _text(value):
+    """A parameter value as str: literals arrive as bytes, and names may be RFC 2047 encoded words."""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if value and '=?' in value:
+        try:
+            value = str(make_header(decode_header(value)))
+        except (email.errors.HeaderParseError, ValueError, LookupError):
+            pass
+    return value
+
+def _params(values):
+    if not isinstance(values, list):
+        return {}
+    params = {str(_text(values[j])).lower(): _text(values[j + 1]) for j in range(0, len(values) - 1, 2)}
+    for name in ('filename', 'name'):
+        # RFC 2231: filename*=utf-8''Voicemail%20van%20...
+        if f'{name}*' in params and name not in params:
+            charset, _, value = email.utils.decode_rfc2231(params[f'{name}*'])
+            try:
+                params[name] = urllib.parse.unquote(value, charset or 'us-ascii', 'replace')
+            except LookupError:
+                params[name] = urllib.parse.unquote(value)
+    return params
+
+def walk_parts(structure, prefix=''):
+    """Yield the leaf parts of a parsed BODYSTRUCTURE with their section numbers."""
+    if isinstance(structure[0], list):
+        number = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            yield from walk_parts(child, f"{prefix}{number}.")
+        return
+
+    content_type = f"{structure[0]}/{structure[1]}".lower()
+    params = _params(structure[2])
+    # Extension data: disposition follows md5, and text parts have a line count before that
+    disposition_index = 9 if content_type.startswith('text/') else 8
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    disposition_params = _params(disposition[1]) if isinstance(disposition, list) and len(disposition) > 1 else {}
+    yield Part(
+        section=prefix + '1' if not prefix else prefix[:-1],
+        content_type=content_type,
+        charset=params.get('charset') or 'utf-8',
+        encoding=(structure[5] or '7bit').lower(),
+        name=disposition_params.get('filename') or params.get('name'),
+    )
+
+def uid_set(uids):
+    """Compress sorted UIDs into an IMAP UID set, e.g. [1, 2, 3, 5] into "1:3,5"."""
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(low) if low == high else f"{low}:{high}" for low, high in ranges)
+
+def decode_part(data, encoding):
+    if isinstance(data, str):
+        data = data.encode()
+    if encoding == 'base64':
+        return binascii.a2b_base64(data)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return bytes(data)
+
+def internaldate(value):
+    """INTERNALDATE as a Unix timestamp, or None."""
+    if not value:
+        return None
+    parsed = imaplib.Internaldate2tuple(b'INTERNALDATE "' + str(value).encode() + b'"')
+    return time.mktime(parsed) if parsed is not None else None
+
+def _check(result, data, what):
+    if result != "OK":
+        raise imaplib.IMAP4.error(f"{what} failed: {data}")
+
+def fetch_voicemails(mail, uids):
+    """
+    Fetch subject, sender, plain text and audio attachments of the given UIDs in two round-trips:
+    one for the structure of all of them and, as the PBX mails all look alike, usually one
+    for their parts. Returns {uid: Voicemail}; UIDs that no longer exist are left out.
+    """
+    uids_in_batch = ",".join(str(uid) for uid in uids)
+    result, data = mail.uid("FETCH", uids_in_batch, "(UID INTERNALDATE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)])")
+    _check(result, data, "Fetching structure")
+
+    wanted = {}
+    groups = defaultdict(list)
+    structures = parse_fetch(data)
+    for uid in uids:
+        # With CONDSTORE or QRESYNC the server may add FETCH responses about other mail, with just FLAGS
+        items = structures.get(uid, {})
+        if items.get('BODYSTRUCTURE') is None:
+            continue
+        parts = list(walk_parts(items['BODYSTRUCTURE']))
+        text = next((part for part in parts if part.content_type == 'text/plain'), None)
+        audio = [part for part in parts if part.content_type.startswith('audio/')]
+        # Servers differ in how they echo the header section name
+        header = next((value for key, value in items.items() if key.startswith('BODY[HEADER.FIELDS')), None) or b''
+        headers = email.message_from_bytes(header if isinstance(header, bytes) else header.encode())
+        wanted[uid] = (headers['subject'], headers['from'], text, audio, internaldate(items.get('INTERNALDATE')))
+        sections = tuple(part.section for part in ([text] if text else []) + audio)
+        groups[sections].append(uid)
+
+    bodies = defaultdict(dict)
+    for sections, group in groups.items():
+        if not sections:
+            continue
+        fetch_items = " ".join(f"BODY.PEEK[{section}]" for section in sections)
+        result, data = mail.uid("FETCH", ",".join(str(uid) for uid in group), f"(UID {fetch_items})")
+        _check(result, data, "Fetching parts")
+        for uid, items in parse_fetch(data).items():
+            bodies[uid].update(items)
+
+    voicemails = {}
+    for uid, (subject, sender, text, audio, received) in wanted.items():
+        items = bodies.get(uid, {})
+        email_text = ""
+        if text is not None:
+            content = decode_part(items.get(f'BODY[{text.section}]') or b'', text.encoding)
+            try:
+                email_text = content.decode(text.charset, 'replace')
+            except LookupError:
+                email_text = content.decode('utf-8', 'replace')
+        attachments = [
+            (part.name or "voicemail.wav", decode_part(items.get(f'BODY[{part.section}]') or b'', part.encoding))
+            for part in audio
+        ]
+        voicemails[uid] = Voicemail(uid, subject, sender, email_text, attachments, received)
+    return voicemails
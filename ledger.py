@@ -0,0 +1,147 @@
+"""
+Durable record of which voicemail mails have been handled, keyed by UIDVALIDITY and UID.
+
+Progress no longer depends on the \\Seen flag, which anyone reading the mailbox can set,
+and a restart resumes from the last checkpoint instead of searching the whole inbox.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+NEW = 'new'
+FETCHED = 'fetched'
+ANNOUNCED = 'announced'
+TRANSCRIBED = 'transcribed'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+class Ledger:
+    def __init__(self, path, max_attempts=5):
+        self.max_attempts = max_attempts
+        # The connection is shared by the event loop and the executor threads. sqlite3 does not keep
+        # their statements and transactions apart, so every method holds this lock while using it.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " mailbox TEXT NOT NULL,"
+            " uidvalidity INTEGER NOT NULL,"
+            " last_uid INTEGER NOT NULL,"
+            " PRIMARY KEY (mailbox, uidvalidity))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " mailbox TEXT NOT NULL,"
+            " uidvalidity INTEGER NOT NULL,"
+            " uid INTEGER NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (mailbox, uidvalidity, uid))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS announcements ("
+            " mailbox TEXT NOT NULL,"
+            " uidvalidity INTEGER NOT NULL,"
+            " uid INTEGER NOT NULL,"
+            " messages TEXT NOT NULL,"
+            " PRIMARY KEY (mailbox, uidvalidity, uid))"
+        )
+        self.db.commit()
+
+    def checkpoint(self, mailbox, uidvalidity):
+        """Highest UID already recorded for this mailbox, or None if it was never checked."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT last_uid FROM checkpoints WHERE mailbox = ? AND uidvalidity = ?",
+                (mailbox, uidvalidity),
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, mailbox, uidvalidity, uids, last_uid):
+        """Record newly found UIDs and move the checkpoint to last_uid, in one transaction."""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO messages (mailbox, uidvalidity, uid, state, updated) VALUES (?, ?, ?, ?, ?)",
+                [(mailbox, uidvalidity, uid, NEW, now) for uid in uids],
+            )
+            self.db.execute(
+                "INSERT INTO checkpoints (mailbox, uidvalidity, last_uid) VALUES (?, ?, ?)"
+                " ON CONFLICT (mailbox, uidvalidity) DO UPDATE SET last_uid = max(last_uid, excluded.last_uid)",
+                (mailbox, uidvalidity, last_uid),
+            )
+
+    def pending(self, mailbox, uidvalidity):
+        """UIDs that still have to be delivered, oldest first."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT uid FROM messages WHERE mailbox = ? AND uidvalidity = ? AND state NOT IN (?, ?) ORDER BY uid",
+                (mailbox, uidvalidity, DELIVERED, FAILED),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def state(self, mailbox, uidvalidity, uid):
+        with self.lock:
+            return self._state(mailbox, uidvalidity, uid)
+
+    def _state(self, mailbox, uidvalidity, uid):
+        row = self.db.execute(
+            "SELECT state FROM messages WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+            (mailbox, uidvalidity, uid),
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, mailbox, uidvalidity, uid, state):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO messages (mailbox, uidvalidity, uid, state, updated) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (mailbox, uidvalidity, uid) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                (mailbox, uidvalidity, uid, state, time.time()),
+            )
+
+    def record_failure(self, mailbox, uidvalidity, uid, error):
+        """Count a failed attempt. Returns True when the message is given up on."""
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "UPDATE messages SET attempts = attempts + 1, error = ?, updated = ?"
+                    " WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                    (str(error), time.time(), mailbox, uidvalidity, uid),
+                )
+                self.db.execute(
+                    "UPDATE messages SET state = ? WHERE mailbox = ? AND uidvalidity = ? AND uid = ? AND attempts >= ?",
+                    (FAILED, mailbox, uidvalidity, uid, self.max_attempts),
+                )
+            return self._state(mailbox, uidvalidity, uid) == FAILED
+
+    def announced(self, mailbox, uidvalidity, uid):
+        """What set_announced() recorded for this mail, or None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT messages FROM announcements WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                (mailbox, uidvalidity, uid),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_announced(self, mailbox, uidvalidity, uid, messages):
+        """
+        Record the Telegram messages sent for this mail, so a retry can edit them instead of sending
+        the voicemail again. messages is anything JSON can hold; None forgets them.
+        """
+        with self.lock, self.db:
+            if messages is None:
+                self.db.execute(
+                    "DELETE FROM announcements WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                    (mailbox, uidvalidity, uid),
+                )
+            else:
+                self.db.execute(
+                    "INSERT INTO announcements (mailbox, uidvalidity, uid, messages) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (mailbox, uidvalidity, uid) DO UPDATE SET messages = excluded.messages",
+                    (mailbox, uidvalidity, uid, json.dumps(messages)),
+                )
@@ -0,0 +1,64 @@
+"""
+The IMAP mailboxes main.py watches, and the Telegram chat each voicemail goes to.
+
+Every [mailbox:<name>] section of config.ini is a mailbox with its own login and a default
+CHATID. ROUTE1, ROUTE2, ... send voicemails whose subject or sender matches a pattern to
+another chat; the first matching route wins:
+
+    ROUTE1 = subject:wachtrij 2 -> -1001234567890
+    ROUTE2 = from:@klant\\.nl$ -> -1009876543210
+
+Without such sections the mailbox in [secrets] is watched, as before.
+"""
+import re
+
+SECTION_PREFIX = "mailbox:"
+ROUTE_FIELDS = ("subject", "from")
+
+class Mailbox:
+    def __init__(self, name, server, port, email, password, chat_id, routes=()):
+        self.name = name
+        self.server = server
+        self.port = port
+        self.email = email
+        self.password = password
+        self.chat_id = chat_id
+        # (field, compiled pattern, chat id)
+        self.routes = list(routes)
+        # Identifies the mailbox in the ledger
+        self.key = f"{email}@{server}/INBOX"
+
+    def chat_for(self, voicemail):
+        """The chat voicemail goes to: that of the first matching route, or the mailbox's own."""
+        for field, pattern, chat_id in self.routes:
+            value = voicemail.subject if field == "subject" else voicemail.sender
+            if pattern.search(value or ""):
+                return chat_id
+        return self.chat_id
+
+def parse_route(rule):
+    """'<subject|from>:<regular expression> -> <chat id>' as (field, pattern, chat id)."""
+    condition, arrow, chat_id = rule.rpartition("->")
+    field, colon, pattern = condition.partition(":")
+    field = field.strip().lower()
+    if not arrow or not colon or field not in ROUTE_FIELDS or not chat_id.strip():
+        raise ValueError(f"Invalid route, expected '<subject|from>:<pattern> -> <chat id>': {rule}")
+    return field, re.compile(pattern.strip(), re.IGNORECASE), chat_id.strip()
+
+def from_section(name, section):
+    # ROUTE10 comes after ROUTE9
+    keys = sorted((key for key in section if key.lower().startswith("route")), key=lambda key: (len(key), key))
+    return Mailbox(name, section["IMAPSERVER"], int(section["IMAPPORT"]), section["EMAIL"], section["PASSWORD"],
+                   section["CHATID"], [parse_route(section[key]) for key in keys])
+
+def load_mailboxes(config):
+    """The mailboxes in config. Raises KeyError for a missing setting, ValueError for a bad route or a duplicate."""
+    mailboxes = [from_section(section[len(SECTION_PREFIX):], config[section])
+                 for section in config.sections() if section.lower().startswith(SECTION_PREFIX)]
+    if not mailboxes:
+        mailboxes = [from_section("default", config["secrets"])]
+    keys = [mailbox.key for mailbox in mailboxes]
+    for key in keys:
+        if keys.count(key) > 1:
+            raise ValueError(f"Mailbox {key} is configured more than once")
+    return mailboxes
@@ -1,25 +1,35 @@
 import asyncio
 import imaplib
-import email
-import os
-import configparser
 import telegram
-from telegram import Bot
-from telegram.error import TelegramError, NetworkError, RetryAfter
-from google.cloud import speech_v1p1beta1 as speech
-from google.oauth2 import service_account
-from pydub import AudioSegment
+from telegram import Bot, InputFile
 from pathlib import Path
 import logging
 import time
 import nest_asyncio
 import random
+import hashlib
+import select
+import ssl
+import signal
+import socket
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from audio import decode_audio, encode_opus
+from segmenter import split_pcm, stitch_transcripts
+from transcription_cache import TranscriptionCache
+import ledger
+from imap_fetch import fetch_voicemails
+from mailboxes import load_mailboxes
+import metrics
+import shared_config
+import telegram_outbox
 
 # Apply the nest_asyncio patch
 nest_asyncio.apply()
 
 # Set up logging directory and file
-log_dir = Path(__file__).resolve().parent / 'logs'
+log_dir = shared_config.log_dir
 log_dir.mkdir(exist_ok=True)
 log_file = log_dir / 'voicemail_notifier.log'
 
@@ -33,22 +43,91 @@ logging.basicConfig(
     ]
 )
 
-config_dir = Path(__file__).resolve().parent / 'config'
-config_file = config_dir / 'config.ini'
+config_dir = shared_config.config_dir
+data_dir = shared_config.data_dir
+data_dir.mkdir(exist_ok=True)
+config_file = shared_config.config_file
 googlekey = config_dir / 'googlekey.json'
-config = configparser.ConfigParser()
-config.read(config_file)
+config = shared_config.load_config()
 
-IMAP_SERVER = config['secrets']['IMAPSERVER']
-IMAP_PORT = int(config['secrets']['IMAPPORT'])
-EMAIL = config['secrets']['EMAIL']
-PASSWORD = config['secrets']['PASSWORD']
 TELEGRAM_TOKEN = config['secrets']['TELEGRAMTOKEN']
-CHAT_ID = config['secrets']['CHATID']
+# The [mailbox:<name>] sections, or the one mailbox in [secrets]
+MAILBOXES = load_mailboxes(config)
 
-# Google API
-credentials = service_account.Credentials.from_service_account_file(googlekey)
-client = speech.SpeechClient(credentials=credentials)
+# Mail watcher settings, all optional
+USE_IDLE = config.getboolean('settings', 'USEIDLE', fallback=True)
+IDLE_TIMEOUT = config.getint('settings', 'IDLETIMEOUT', fallback=120)
+POLL_INTERVAL = config.getint('settings', 'POLLINTERVAL', fallback=10)
+MAX_BACKOFF = 300
+MIN_SESSION_UPTIME = 60
+MAX_ATTEMPTS = config.getint('settings', 'MAXATTEMPTS', fallback=5)
+FETCH_BATCH = config.getint('settings', 'FETCHBATCH', fallback=10)
+# Seconds after which a voicemail that arrived while we were down counts as backlog
+BACKLOG_AGE = config.getint('settings', 'BACKLOGAGE', fallback=600)
+
+# Pipeline settings, all optional
+QUEUE_SIZE = config.getint('settings', 'QUEUESIZE', fallback=10)
+DECODE_WORKERS = config.getint('settings', 'DECODEWORKERS', fallback=2)
+TRANSCRIBE_WORKERS = config.getint('settings', 'TRANSCRIBEWORKERS', fallback=4)
+DELIVER_WORKERS = config.getint('settings', 'DELIVERWORKERS', fallback=2)
+ORDERED_DELIVERY = config.getboolean('settings', 'ORDEREDDELIVERY', fallback=True)
+DRAIN_TIMEOUT = config.getint('settings', 'DRAINTIMEOUT', fallback=60)
+
+# Transcription settings, all optional
+TRANSCRIBE_CONCURRENCY = config.getint('settings', 'TRANSCRIBECONCURRENCY', fallback=4)
+TRANSCRIBE_RETRIES = config.getint('settings', 'TRANSCRIBERETRIES', fallback=2)
+GAP_MARKER = config.get('settings', 'GAPMARKER', fallback='[...]')
+SEGMENT_OVERLAP = config.getint('settings', 'SEGMENTOVERLAP', fallback=500)
+SILENCE_THRESHOLD = config.getfloat('settings', 'SILENCETHRESHOLD', fallback=-40.0)
+SAMPLE_RATE = 8000
+# LINEAR16 audio shorter than a minute can be recognized synchronously
+SYNC_RECOGNITION_BYTES = 60 * SAMPLE_RATE * 2
+RECOGNITION_TIMEOUT = 300
+LANGUAGE_CODE = "nl-NL"
+CACHE_ENABLED = config.getboolean('settings', 'CACHEENABLED', fallback=True)
+CACHE_MAX_ENTRIES = config.getint('settings', 'CACHEMAXENTRIES', fallback=10000)
+CACHE_MAX_AGE_DAYS = config.getint('settings', 'CACHEMAXAGEDAYS', fallback=30)
+
+# Telegram settings, all optional
+VOICE_FORMAT = config.get('settings', 'VOICEFORMAT', fallback='wav').lower()
+MAX_CAPTION_LENGTH = 1024
+MAX_MESSAGE_LENGTH = 4096
+# Seconds between two edits of a voice message while its transcript comes in
+EDIT_INTERVAL = config.getfloat('settings', 'EDITINTERVAL', fallback=3)
+TRANSCRIBING_MARKER = " ..."
+
+# Metrics settings, all optional. Without METRICSPORT nothing is served.
+METRICS_PORT = config.getint('settings', 'METRICSPORT', fallback=0)
+METRICS_HOST = config.get('settings', 'METRICSHOST', fallback='127.0.0.1')
+SLOWEST_MESSAGES = config.getint('settings', 'SLOWESTMESSAGES', fallback=0)
+
+imap_seconds = metrics.Histogram('voicemail_imap_seconds', 'IMAP operations by the mail watcher.', ['op'])
+stage_seconds = metrics.Histogram('voicemail_stage_seconds', 'Time a voicemail spent in a pipeline stage.', ['stage'])
+recognition_seconds = metrics.Histogram('voicemail_recognition_seconds', 'Google recognition of one segment.')
+end_to_end_seconds = metrics.Histogram('voicemail_end_to_end_seconds', 'From fetching a voicemail to its outcome.')
+first_notification_seconds = metrics.Histogram('voicemail_first_notification_seconds',
+                                               'From fetching a voicemail to its voice message in the chat.')
+retries_total = metrics.Counter('voicemail_retries_total', 'Failed attempts that were retried.', ['op'])
+cache_lookups_total = metrics.Counter('voicemail_transcription_cache_total', 'Transcription cache lookups.', ['result'])
+voicemails_total = metrics.Counter('voicemail_messages_total', 'Voicemails that went through the pipeline.', ['outcome'])
+if SLOWEST_MESSAGES:
+    metrics.track_slowest(SLOWEST_MESSAGES)
+
+# Google API, created on first use by speech_client()
+client = None
+client_lock = threading.Lock()
+# Telegram, created on first use by get_bot() and get_outbox() unless the supervisor hands in shared ones
+bot = None
+outbox = None
+transcribe_semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+# Recognition blocks for seconds per segment; in threads of its own it never waits behind other blocking work
+recognition_executor = ThreadPoolExecutor(TRANSCRIBE_CONCURRENCY, thread_name_prefix="recognize")
+message_ledger = ledger.Ledger(data_dir / 'ledger.db', MAX_ATTEMPTS)
+transcription_cache = None
+# sha256 of an attachment -> Telegram file_id of its upload
+uploaded_files = {}
+if CACHE_ENABLED:
+    transcription_cache = TranscriptionCache(data_dir / 'transcriptions.db', CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS)
 
 def split_text(text, max_length):
     parts = []
@@ -58,155 +137,713 @@ def split_text(text, max_length):
         text = text[max_length:]
     return parts
 
-async def convert_speech_to_text_inline(audio_content):
-    try:
-        language_code = "nl-NL"
-        sample_rate_hertz = 8000
+def speech_client():
+    """The Google speech client. Importing it pulls in grpc, which is slow, so that waits until it is needed."""
+    global client
+    with client_lock:
+        if client is None:
+            from google.cloud import speech_v1p1beta1 as speech
+            from google.oauth2 import service_account
+            credentials = service_account.Credentials.from_service_account_file(googlekey)
+            client = speech.SpeechClient(credentials=credentials)
+    return client
 
-        audio = speech.RecognitionAudio(content=audio_content)
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=sample_rate_hertz,
-            language_code=language_code,
-        )
+def get_bot():
+    global bot
+    if bot is None:
+        bot = Bot(token=TELEGRAM_TOKEN)
+    return bot
 
-        operation = client.long_running_recognize(config=config, audio=audio)
-        logging.info("Waiting for operation to complete...")
-        response = operation.result(timeout=300)
+def get_outbox():
+    global outbox
+    if outbox is None:
+        outbox = telegram_outbox.Outbox.from_config(get_bot(), config)
+    return outbox
 
-        transcript = ""
-        for result in response.results:
-            transcript += result.alternatives[0].transcript
+def recognize(audio_content):
+    """Blocking Google recognition of one LINEAR16 segment."""
+    from google.cloud import speech_v1p1beta1 as speech
+    language_code = LANGUAGE_CODE
+    sample_rate_hertz = SAMPLE_RATE
 
-        return transcript
-    except Exception as e:
-        logging.error(f"Error in convert_speech_to_text_inline: {e}")
-        return ""
+    audio = speech.RecognitionAudio(content=audio_content)
+    config = speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+        sample_rate_hertz=sample_rate_hertz,
+        language_code=language_code,
+    )
+
+    with recognition_seconds.time():
+        if len(audio_content) < SYNC_RECOGNITION_BYTES:
+            # The answer comes back in the response, without an operation to poll
+            response = speech_client().recognize(config=config, audio=audio, timeout=RECOGNITION_TIMEOUT)
+        else:
+            operation = speech_client().long_running_recognize(config=config, audio=audio)
+            logging.info("Waiting for operation to complete...")
+            response = operation.result(timeout=RECOGNITION_TIMEOUT)
+
+    transcript = ""
+    for result in response.results:
+        transcript += result.alternatives[0].transcript
+
+    return transcript
 
-def split_audio(audio_path, segment_duration_ms):
+async def run_in(executor, func, *args):
+    """asyncio.to_thread(), but in executor instead of the default one."""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+async def convert_speech_to_text_inline(audio_content):
+    if transcription_cache is None:
+        # The Google client blocks until the operation is done, keep it off the event loop
+        return await run_in(recognition_executor, recognize, audio_content)
+
+    key = TranscriptionCache.key(audio_content, LANGUAGE_CODE, SAMPLE_RATE)
+    transcript = transcription_cache.get(key)
+    cache_lookups_total.inc(result="miss" if transcript is None else "hit")
+    if transcript is None:
+        transcript = await run_in(recognition_executor, recognize, audio_content)
+        transcription_cache.put(key, transcript)
+    return transcript
+
+def split_audio(audio_content, segment_duration_ms):
     try:
-        audio = AudioSegment.from_file(audio_path)
-        segments = []
-        
-        start = 0
-        while start < len(audio):
-            end = start + segment_duration_ms
-            segment = audio[start:end]
-            segments.append(segment)
-            start = end
-        
-        return segments
+        # Recognition is configured for 8 kHz mono LINEAR16
+        pcm = decode_audio(audio_content, SAMPLE_RATE)
+        return split_pcm(pcm, SAMPLE_RATE, max_ms=segment_duration_ms,
+                         silence_thresh=SILENCE_THRESHOLD, overlap_ms=SEGMENT_OVERLAP)
     except Exception as e:
         logging.error(f"Error in split_audio: {e}")
         return []
 
-async def process_and_combine_segments(segments):
-    try:
-        combined_transcription = ""
+async def transcribe_segment(index, segment):
+    """Transcribe one segment, retrying on failure. A segment that keeps failing becomes GAP_MARKER."""
+    async with transcribe_semaphore:
+        for attempt in range(1, TRANSCRIBE_RETRIES + 2):
+            try:
+                return await convert_speech_to_text_inline(segment.pcm)
+            except Exception as e:
+                logging.error(f"Error transcribing segment {index} (Attempt {attempt}/{TRANSCRIBE_RETRIES + 1}): {e}")
+                if attempt <= TRANSCRIBE_RETRIES:
+                    retries_total.inc(op="recognition")
+                    await asyncio.sleep(2 ** attempt + random.random())
+    return GAP_MARKER
 
-        for segment in segments:
-            text = await convert_speech_to_text_inline(segment.raw_data)
-            combined_transcription += text + " "
+async def process_and_combine_segments(segments, on_progress=None):
+    """
+    Transcribe all segments concurrently (at most TRANSCRIBE_CONCURRENCY at a time)
+    and join the transcripts in the original order. Each time the segments transcribed
+    from the start on grow, on_progress is called with the transcript up to there.
+    """
+    texts = [None] * len(segments)
+    overlapped = [segment.overlapped for segment in segments]
+    shown = 0
 
-        return combined_transcription.strip()
+    async def run(index):
+        nonlocal shown
+        texts[index] = await transcribe_segment(index + 1, segments[index])
+        done = shown
+        while done < len(texts) and texts[done] is not None:
+            done += 1
+        if on_progress is not None and shown < done < len(texts):
+            shown = done
+            on_progress(stitch_transcripts(texts[:done], overlapped[:done]).strip())
+
+    try:
+        await asyncio.gather(*(run(index) for index in range(len(segments))))
+        return stitch_transcripts(texts, overlapped).strip()
     except Exception as e:
         logging.error(f"Error in process_and_combine_segments: {e}")
         return ""
 
-async def send_telegram_message_async(texts, audio_path):
+async def send_to_telegram(method, chat_id, lane, **kwargs):
     """
-    Send Telegram messages with an audio file. If a single message exceeds the maximum caption length,
-    split it into multiple parts and send each part as a separate message with the audio attached.
+    Send through the outbox, which keeps to Telegram's rate limits and retries network errors.
+    Returns the result, or None when it could not be sent.
     """
     try:
-        bot = Bot(token=TELEGRAM_TOKEN)
-        for text in texts:
-            # Split long text into multiple parts
-            text_parts = split_text(text, 1024 - 20)  # Leave room for "Part x/y: " prefix
-            for i, part in enumerate(text_parts, start=1):
-                caption = f"Part {i}/{len(text_parts)}: " + part
-                retry = True
-                attempt = 0
-                while retry and attempt < 5:
-                    try:
-                        # Re-open the audio file for each message part
-                        with open(audio_path, 'rb') as audio_file:
-                            await bot.send_voice(chat_id=CHAT_ID, voice=audio_file, caption=caption, parse_mode="Markdown")
-                        retry = False
-                    except NetworkError as e:
-                        attempt += 1
-                        wait_time = min(60, 2 ** attempt + random.random() * attempt)
-                        logging.error(f"NetworkError: {e}, retrying in {wait_time} seconds... (Attempt {attempt}/5)")
-                        await asyncio.sleep(wait_time)
-                    except RetryAfter as e:
-                        logging.error(f"Rate limited by Telegram, retrying after {e.retry_after} seconds...")
-                        await asyncio.sleep(e.retry_after)
-                    except TelegramError as e:
-                        logging.error(f"TelegramError: {e}")
-                        retry = False
-                    except Exception as e:
-                        logging.error(f"Error in send_telegram_message_async: {e}")
-                        retry = False
+        return await get_outbox().send(method, chat_id, lane, **kwargs)
     except Exception as e:
-        logging.error(f"Error in send_telegram_message_async: {e}")
+        logging.error(f"Error in {method}: {e}")
+        return None
 
-async def main_async():
-    while True:
+async def voice_file(audio_content, audio_name):
+    if VOICE_FORMAT == "opus":
         try:
-            mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-            mail.login(EMAIL, PASSWORD)
-            mail.select("inbox")
-            logging.info("Connected to email server and selected inbox.")
-
-            result, data = mail.search(None, 'UNSEEN SUBJECT "PBX"')
-            email_ids = data[0].split()
-
-            if email_ids:
-                for email_id in email_ids:
-                    try:
-                        result, email_data = mail.fetch(email_id, "(RFC822)")
-                        raw_email = email_data[0][1]
-                        msg = email.message_from_bytes(raw_email)
-
-                        subject = msg["subject"]
-                        email_text = ""
-                        combined_text = ""
-
-                        for part in msg.walk():
-                            if part.get_content_type() == "text/plain":
-                                email_text = part.get_payload(decode=True).decode("utf-8")
-                            elif part.get_content_type().startswith("audio/"):
-                                audio_content = part.get_payload(decode=True)
-                                file_path = "audio.wav"
-                                with open(file_path, "wb") as audio_file:
-                                    audio_file.write(audio_content)
-
-                                segment_duration_ms = 59000  
-                                segments = split_audio(file_path, segment_duration_ms)
-                                combined_text = await process_and_combine_segments(segments)
-                                
-                                if len(combined_text) > 1024:
-                                    text_parts = split_text(combined_text, 1024)
-                                else:
-                                    text_parts = [combined_text]
-
-                                telegram_message = f"Subject: {subject}\nEmail Text: {email_text}\n\nTranscription: "
-                                await send_telegram_message_async([telegram_message + part for part in text_parts], file_path)
-                        mail.store(email_id, "+FLAGS", "\\Seen")
-                    except Exception as e:
-                        logging.error(f"Error processing email ID {email_id}: {e}")
+            ogg = await asyncio.to_thread(encode_opus, audio_content)
+            return InputFile(ogg, filename=Path(audio_name).with_suffix(".ogg").name)
+        except Exception as e:
+            logging.error(f"Error transcoding to Opus, sending the original audio: {e}")
+    return InputFile(audio_content, filename=audio_name)
+
+async def send_voice_message(chat_id, lane, caption, audio_content, audio_name):
+    """
+    Send the audio as a voice message. It is uploaded once: the file_id Telegram returns is
+    reused when the same audio is sent again. Returns the message, or None when it could not be sent.
+    """
+    file_key = hashlib.sha256(audio_content).hexdigest()
+    voice = uploaded_files.get(file_key)
+    if voice is None:
+        voice = await voice_file(audio_content, audio_name)
+    message = await send_to_telegram("send_voice", chat_id, lane, voice=voice, caption=caption, parse_mode="Markdown")
+    if message is None:
+        return None
+
+    # A WAV file may come back as audio or document rather than as voice
+    attachment = message.voice or message.audio or message.document
+    if attachment is not None:
+        uploaded_files[file_key] = attachment.file_id
+        if len(uploaded_files) > 100:
+            uploaded_files.pop(next(iter(uploaded_files)))
+    return message
+
+class LiveTranscript:
+    """
+    The voice message of one voicemail, sent before its transcript is there. As the transcript
+    comes in it is filled into the caption, and what does not fit into messages replying to it.
+    Telegram limits how often a message may change, so edits are EDIT_INTERVAL seconds apart;
+    the complete transcript is always shown.
+    """
+    def __init__(self, chat_id, lane, header):
+        self.chat_id = chat_id
+        self.lane = lane
+        self.header = header
+        self.message_id = None
+        # Text shown in the caption, then in each reply, and the ids of the replies
+        self.shown = []
+        self.replies = []
+        self.text = ""
+        self.changed = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def parts(self, text):
+        text = self.header + text
+        return [text[:MAX_CAPTION_LENGTH]] + split_text(text[MAX_CAPTION_LENGTH:], MAX_MESSAGE_LENGTH)
+
+    async def send(self, audio_content, audio_name):
+        """Send the voice message, with TRANSCRIBING_MARKER where the transcript will be. Returns True when sent."""
+        parts = self.parts(TRANSCRIBING_MARKER)
+        message = await send_voice_message(self.chat_id, self.lane, parts[0], audio_content, audio_name)
+        if message is None:
+            return False
+        self.message_id = message.message_id
+        self.shown = parts[:1]
+        return await self.update(TRANSCRIBING_MARKER)
+
+    def sent(self):
+        """The messages sent so far and what they show, for resume()."""
+        return {"message_id": self.message_id, "replies": self.replies, "shown": self.shown}
+
+    def resume(self, sent):
+        """Take over the messages an earlier attempt sent, so they are edited instead of sent again."""
+        self.message_id = sent["message_id"]
+        self.replies = list(sent["replies"])
+        self.shown = list(sent["shown"])
+
+    async def update(self, text):
+        """Edit and send messages until text is shown. Returns True when Telegram took all of it."""
+        parts = self.parts(text)
+        for i, part in enumerate(parts):
+            if i < len(self.shown) and self.shown[i] == part:
+                continue
+            if i == 0:
+                sent = await send_to_telegram("edit_message_caption", self.chat_id, self.lane,
+                                              message_id=self.message_id, caption=part, parse_mode="Markdown")
+            elif i <= len(self.replies):
+                sent = await send_to_telegram("edit_message_text", self.chat_id, self.lane,
+                                              message_id=self.replies[i - 1], text=part, parse_mode="Markdown")
+            else:
+                sent = await send_to_telegram("send_message", self.chat_id, self.lane, text=part,
+                                              reply_to_message_id=self.message_id, parse_mode="Markdown")
+                if sent is not None:
+                    self.replies.append(sent.message_id)
+            if sent is None:
+                return False
+            if i < len(self.shown):
+                self.shown[i] = part
             else:
-                if os.path.exists("audio.wav"):
-                    os.remove("audio.wav")
+                self.shown.append(part)
+        # Dropping TRANSCRIBING_MARKER can leave a reply with nothing in it
+        while len(self.replies) >= len(parts):
+            reply = self.replies.pop()
+            self.shown.pop()
+            await send_to_telegram("delete_message", self.chat_id, self.lane, message_id=reply)
+        return True
+
+    def show(self, text):
+        """Show the transcript so far, as soon as EDIT_INTERVAL allows."""
+        self.text = text + TRANSCRIBING_MARKER
+        self.changed.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self.keep_updated())
+
+    async def keep_updated(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            # A failed intermediate edit is left to the next one, or to finish()
+            async with self.lock:
+                await self.update(self.text)
+            await asyncio.sleep(EDIT_INTERVAL)
+
+    async def finish(self, text):
+        """Show the complete transcript. Returns True when Telegram took all of it."""
+        async with self.lock:
+            self.cancel()
+            return await self.update(text)
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+async def announce(job):
+    voicemail = job.voicemail
+    # Voice messages an earlier attempt sent get their transcript filled in rather than being sent again
+    sent = message_ledger.announced(job.mailbox.key, job.uidvalidity, voicemail.uid) or []
+    for index, (audio_name, audio_content) in enumerate(voicemail.attachments):
+        live = LiveTranscript(job.chat_id, job.lane, f"Subject: {voicemail.subject}\nEmail Text: {voicemail.text}\n\nTranscription: ")
+        job.live.append(live)
+        if index < len(sent):
+            live.resume(sent[index])
+        elif not await live.send(audio_content, audio_name):
+            raise RuntimeError("Sending to Telegram failed")
+    message_ledger.set_announced(job.mailbox.key, job.uidvalidity, voicemail.uid, [live.sent() for live in job.live])
+    message_ledger.set_state(job.mailbox.key, job.uidvalidity, voicemail.uid, ledger.ANNOUNCED)
+    if len(sent) < len(voicemail.attachments):
+        first_notification_seconds.observe(time.monotonic() - job.started)
+
+async def decode(job):
+    segment_duration_ms = 59000
+    for audio_name, audio_content in job.voicemail.attachments:
+        # Decoding may start ffmpeg and splitting is CPU bound, keep both off the event loop
+        job.segments.append(await asyncio.to_thread(split_audio, audio_content, segment_duration_ms))
+
+async def transcribe(job):
+    job.transcripts = await asyncio.gather(*(process_and_combine_segments(segments, live.show)
+                                             for segments, live in zip(job.segments, job.live)))
+    message_ledger.set_state(job.mailbox.key, job.uidvalidity, job.voicemail.uid, ledger.TRANSCRIBED)
+    for live, combined_text in zip(job.live, job.transcripts):
+        if not await live.finish(combined_text):
+            raise RuntimeError("Sending the transcription to Telegram failed")
+
+class Job:
+    """One voicemail mail on its way through the pipeline."""
+    def __init__(self, mailbox, uidvalidity, voicemail, chat_id, lane, seq):
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.voicemail = voicemail
+        self.chat_id = chat_id
+        # telegram_outbox.LIVE, or BULK for a voicemail that has been waiting since before an outage
+        self.lane = lane
+        self.seq = seq
+        self.live = []
+        self.segments = []
+        self.transcripts = []
+        self.error = None
+        self.started = time.monotonic()
+        # stage -> seconds, for the slowest messages dump
+        self.timings = {}
+
+class Pipeline:
+    """
+    Fetched voicemails pass through announce, decode and transcribe stages. Announcing sends
+    the voice message right away, so the chat hears of a voicemail before it is transcribed;
+    the transcript is filled in while the segments are recognized. The stages are connected
+    by bounded queues and each has its own workers, so a slow transcription or a Telegram
+    rate limit only holds up its own stage. A full queue makes the stage before it wait. A job
+    that fails in any stage still goes all the way through, so finish() is the one place that
+    records the outcome in the ledger. Voice messages reach a chat in the order the mails were
+    fetched, except that live voicemails go ahead of a backlog.
+    """
+    def __init__(self):
+        self.announce_queue = asyncio.Queue(QUEUE_SIZE)
+        self.decode_queue = asyncio.Queue(QUEUE_SIZE)
+        self.transcribe_queue = asyncio.Queue(QUEUE_SIZE)
+        self.workers = []
+        # (mailbox key, uidvalidity, uid) of jobs in the pipeline, so the watchers do not fetch them again
+        self.in_flight = set()
+        # (mailbox key, uidvalidity, uid) of delivered mails the watchers still have to mark \Seen
+        self.delivered = []
+        self.next_seq = defaultdict(int)
+        self.next_announce = defaultdict(int)
+        self.waiting = defaultdict(dict)
+        self.chat_locks = defaultdict(asyncio.Lock)
+        # Jobs waiting for their turn to be announced are out of announce_queue, but still count
+        # against QUEUE_SIZE, so a backlog cannot be fetched into memory all at once
+        self.announce_slots = asyncio.Semaphore(QUEUE_SIZE)
+
+    def start(self):
+        for _ in range(DELIVER_WORKERS):
+            self.workers.append(asyncio.create_task(self.run_announce()))
+        for _ in range(DECODE_WORKERS):
+            self.workers.append(asyncio.create_task(self.run_stage(self.decode_queue, decode, self.transcribe_queue)))
+        for _ in range(TRANSCRIBE_WORKERS):
+            self.workers.append(asyncio.create_task(self.run_stage(self.transcribe_queue, transcribe)))
+
+    async def submit(self, mailbox, uidvalidity, voicemail, chat_id):
+        self.in_flight.add((mailbox.key, uidvalidity, voicemail.uid))
+        lane = telegram_outbox.LIVE
+        if voicemail.received is not None and time.time() - voicemail.received > BACKLOG_AGE:
+            lane = telegram_outbox.BULK
+        # Before taking a seq: a job whose turn comes first must never wait for a slot
+        await self.announce_slots.acquire()
+        seq = self.next_seq[chat_id, lane]
+        self.next_seq[chat_id, lane] += 1
+        await self.announce_queue.put(Job(mailbox, uidvalidity, voicemail, chat_id, lane, seq))
+
+    async def handle(self, job, handle):
+        if job.error is None:
+            started = time.monotonic()
+            try:
+                await handle(job)
+            except Exception as e:
+                job.error = e
+            job.timings[handle.__name__] = time.monotonic() - started
+            stage_seconds.observe(job.timings[handle.__name__], stage=handle.__name__)
+
+    async def run_stage(self, queue, handle, next_queue=None):
+        while True:
+            job = await queue.get()
+            await self.handle(job, handle)
+            # Hand over before task_done(), so draining the queues in order sees every job
+            if next_queue is None:
+                self.finish(job)
+            else:
+                await next_queue.put(job)
+            queue.task_done()
+
+    async def run_announce(self):
+        while True:
+            job = await self.announce_queue.get()
+            if not ORDERED_DELIVERY:
+                await self.handle(job, announce)
+                await self.decode_queue.put(job)
+                self.announce_slots.release()
+                self.announce_queue.task_done()
+                continue
+
+            # Live voicemails only wait for each other, not for the backlog
+            order = (job.chat_id, job.lane)
+            waiting = self.waiting[order]
+            waiting[job.seq] = job
+            lock = self.chat_locks[order]
+            if lock.locked():
+                # The worker announcing to this chat picks the job up when it is its turn
+                continue
+            async with lock:
+                while self.next_announce[order] in waiting:
+                    next_job = waiting.pop(self.next_announce[order])
+                    await self.handle(next_job, announce)
+                    self.next_announce[order] += 1
+                    await self.decode_queue.put(next_job)
+                    self.announce_slots.release()
+                    self.announce_queue.task_done()
+
+    def finish(self, job):
+        key = (job.mailbox.key, job.uidvalidity, job.voicemail.uid)
+        outcome = "delivered"
+        if job.error is None:
+            message_ledger.set_state(job.mailbox.key, job.uidvalidity, job.voicemail.uid, ledger.DELIVERED)
+            message_ledger.set_announced(job.mailbox.key, job.uidvalidity, job.voicemail.uid, None)
+            self.delivered.append(key)
+        else:
+            for live in job.live:
+                live.cancel()
+            outcome = "retry"
+            logging.error(f"Error processing email UID {job.voicemail.uid} in {job.mailbox.name}: {job.error}")
+            sent = [live.sent() for live in job.live if live.message_id is not None]
+            if sent:
+                # The next attempt edits these messages instead of sending the voicemail again
+                message_ledger.set_announced(job.mailbox.key, job.uidvalidity, job.voicemail.uid, sent)
+            if message_ledger.record_failure(job.mailbox.key, job.uidvalidity, job.voicemail.uid, job.error):
+                outcome = "failed"
+                message_ledger.set_announced(job.mailbox.key, job.uidvalidity, job.voicemail.uid, None)
+                logging.error(f"Giving up on email UID {job.voicemail.uid} in {job.mailbox.name} after {MAX_ATTEMPTS} attempts.")
+        self.in_flight.discard(key)
+
+        elapsed = time.monotonic() - job.started
+        voicemails_total.inc(outcome=outcome)
+        end_to_end_seconds.observe(elapsed)
+        if metrics.slowest is not None:
+            metrics.slowest.record(elapsed, uid=job.voicemail.uid, subject=job.voicemail.subject, outcome=outcome,
+                                   stages={stage: round(seconds, 3) for stage, seconds in job.timings.items()})
+
+    def take_delivered(self, mailbox, uidvalidity):
+        uids = [uid for key, validity, uid in self.delivered if key == mailbox.key and validity == uidvalidity]
+        self.delivered = [delivered for delivered in self.delivered if delivered[0] != mailbox.key]
+        return uids
+
+    async def drain(self, timeout):
+        """Let the jobs already in the pipeline finish, then stop the workers."""
+        async def join():
+            await self.announce_queue.join()
+            await self.decode_queue.join()
+            await self.transcribe_queue.join()
+        try:
+            await asyncio.wait_for(join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{len(self.in_flight)} voicemails not finished, they are retried after the restart.")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+def search_mailbox(mailbox, mail, uidvalidity, uidnext):
+    """
+    Record voicemail mails that arrived after the checkpoint in the ledger. The very first
+    check has no checkpoint yet and picks up the unseen mails instead. Returns their UIDs.
+    """
+    checkpoint = message_ledger.checkpoint(mailbox.key, uidvalidity)
+    with imap_seconds.time(op="search"):
+        if checkpoint is None:
+            result, data = mail.uid("SEARCH", None, 'UNSEEN SUBJECT "PBX"')
+        else:
+            result, data = mail.uid("SEARCH", None, f'UID {checkpoint + 1}:* SUBJECT "PBX"')
+    if result != "OK":
+        raise imaplib.IMAP4.error(f"Search failed: {data}")
+    uids = [int(uid) for uid in data[0].split()]
+
+    if checkpoint is None:
+        checkpoint = max(uids, default=0) if uidnext is None else uidnext - 1
+    else:
+        # "n:*" always matches the newest mail, even when its UID is below n
+        uids = [uid for uid in uids if uid > checkpoint]
+    message_ledger.add(mailbox.key, uidvalidity, uids, max([checkpoint] + uids))
+    return set(uids)
+
+async def check_mailbox(mailbox, mail, imap_thread, uidvalidity, uidnext, pipeline):
+    """
+    Search for new voicemails and feed everything the ledger still has pending into the pipeline.
+    While a backlog is fed in batch by batch, the mailbox is searched again after each batch, so
+    mail that arrives meanwhile goes ahead of the rest of the backlog.
+    """
+    new = await run_in(imap_thread, search_mailbox, mailbox, mail, uidvalidity, uidnext)
+    submitted = set()
+    while True:
+        pending = [uid for uid in message_ledger.pending(mailbox.key, uidvalidity)
+                   if (mailbox.key, uidvalidity, uid) not in pipeline.in_flight and uid not in submitted]
+        if not pending:
+            return
+        batch = sorted(pending, key=lambda uid: uid not in new)[:FETCH_BATCH]
+        # Only the text and audio parts are downloaded, with BODY.PEEK so \Seen
+        # is only set once the voicemail is delivered
+        with imap_seconds.time(op="fetch"):
+            voicemails = await run_in(imap_thread, fetch_voicemails, mail, batch)
+        for uid in batch:
+            submitted.add(uid)
+            voicemail = voicemails.get(uid)
+            if voicemail is None:
+                logging.error(f"Email UID {uid} is no longer in {mailbox.name}.")
+                message_ledger.set_state(mailbox.key, uidvalidity, uid, ledger.FAILED)
+                continue
+            message_ledger.set_state(mailbox.key, uidvalidity, uid, ledger.FETCHED)
+            await pipeline.submit(mailbox, uidvalidity, voicemail, mailbox.chat_for(voicemail))
+        if len(pending) <= FETCH_BATCH:
+            return
+        new = await run_in(imap_thread, search_mailbox, mailbox, mail, uidvalidity, uidnext)
+
+def mark_seen(mail, uids):
+    if uids:
+        with imap_seconds.time(op="store"):
+            mail.uid("STORE", ",".join(str(uid) for uid in uids), "+FLAGS.SILENT", "(\\Seen)")
+
+def connect_imap(mailbox):
+    """Log in and select the inbox. Returns the connection with the inbox's UIDVALIDITY and UIDNEXT."""
+    with imap_seconds.time(op="login"):
+        mail = imaplib.IMAP4_SSL(mailbox.server, mailbox.port)
+        mail.login(mailbox.email, mailbox.password)
+        mail.select("inbox")
+    _, uidvalidity = mail.response("UIDVALIDITY")
+    _, uidnext = mail.response("UIDNEXT")
+    # The first check looks at the whole mailbox anyway; left here, idle_wait() would take them for new mail
+    mail.response("EXISTS")
+    mail.response("RECENT")
+    return mail, int(uidvalidity[0]), int(uidnext[0]) if uidnext[0] else None
+
+def supports_idle(mail):
+    # Servers often only advertise IDLE after login, so ask again
+    result, data = mail.capability()
+    if result != "OK":
+        return False
+    return b"IDLE" in data[0].upper().split()
+
+def data_waiting(mail):
+    """
+    Whether the server sent something not read yet. select() only sees the socket, not what the
+    SSL layer or imaplib's own buffer (mail.file) already holds, so peek there without blocking.
+    """
+    timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+def idle_wait(mail, timeout):
+    """
+    Wait in IMAP IDLE (RFC 2177) until the server reports a mailbox change or the timeout passes.
+    Blocks, so run it in a thread. Returns True if the server reported new mail.
+    """
+    # New mail reported during an earlier command (a FETCH or STORE) ends up in untagged_responses
+    # and is not reported again in IDLE, so check the mailbox first
+    reported = [mail.untagged_responses.pop(name, None) for name in ("EXISTS", "RECENT")]
+    if any(reported):
+        return True
+
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    line = mail.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not data_waiting(mail):
+            readable, _, _ = select.select([mail.sock], [], [], remaining)
+            if not readable:
+                break
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE")
+        if line.rstrip().endswith((b"EXISTS", b"RECENT")):
+            changed = True
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed while ending IDLE")
+        if line.startswith(tag):
+            if not line[len(tag):].strip().startswith(b"OK"):
+                raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+            return changed
+        if line.rstrip().endswith((b"EXISTS", b"RECENT")):
+            changed = True
+
+def next_backoff(current):
+    if current <= 0:
+        return POLL_INTERVAL
+    return min(current * 2, MAX_BACKOFF)
+
+async def sleep_unless_stopping(stopping, seconds):
+    try:
+        await asyncio.wait_for(stopping.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+async def wait_for_mail(mail, imap_thread, stopping):
+    """IDLE until the server reports new mail or IDLE_TIMEOUT passes. Shutting down interrupts it."""
+    idle = asyncio.create_task(run_in(imap_thread, idle_wait, mail, IDLE_TIMEOUT))
+    stop = asyncio.create_task(stopping.wait())
+    try:
+        await asyncio.wait({idle, stop}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop.cancel()
+        if not idle.done():
+            # Closing our side makes the IDLE thread see the connection end
+            mail.sock.shutdown(socket.SHUT_RDWR)
+            await asyncio.gather(idle, return_exceptions=True)
+    if stopping.is_set():
+        return
+    if idle.result():
+        logging.info("IMAP server reported new mail.")
+
+async def watch_mailbox(mailbox, pipeline, stopping):
+    """
+    Keep one authenticated IMAP connection to mailbox open. With IDLE the server pushes new mail
+    to us, otherwise the open connection is polled. A dropped connection is re-established with
+    backoff. Every mailbox has its own watcher, feeding the one shared pipeline.
+
+    The connection is only used from the watcher's own thread. IDLE keeps it busy for minutes
+    at a time, which in the default executor would leave fewer threads for everything else.
+    """
+    imap_thread = ThreadPoolExecutor(1, thread_name_prefix=f"imap-{mailbox.name}")
+    try:
+        await watch_connection(mailbox, imap_thread, pipeline, stopping)
+    finally:
+        imap_thread.shutdown(wait=False)
+
+async def watch_connection(mailbox, imap_thread, pipeline, stopping):
+    backoff = 0
+    while not stopping.is_set():
+        mail = None
+        started = time.monotonic()
+        try:
+            mail, uidvalidity, uidnext = await run_in(imap_thread, connect_imap, mailbox)
+            # Other mailboxes are watched on the same event loop, so nothing may block it
+            use_idle = USE_IDLE and await run_in(imap_thread, supports_idle, mail)
+            if USE_IDLE and not use_idle:
+                logging.warning(f"IMAP server of {mailbox.name} does not support IDLE, falling back to polling.")
+            logging.info(f"Connected to email server and selected inbox of {mailbox.name} (idle: {use_idle}).")
+
+            while not stopping.is_set():
+                await check_mailbox(mailbox, mail, imap_thread, uidvalidity, uidnext, pipeline)
+                await run_in(imap_thread, mark_seen, mail, pipeline.take_delivered(mailbox, uidvalidity))
+                if use_idle:
+                    await wait_for_mail(mail, imap_thread, stopping)
+                else:
+                    await sleep_unless_stopping(stopping, POLL_INTERVAL)
 
         except imaplib.IMAP4.abort as e:
-            logging.error(f"IMAP connection error: {e}")
+            if not stopping.is_set():
+                logging.error(f"IMAP connection error ({mailbox.name}): {e}")
         except imaplib.IMAP4.error as e:
-            logging.error(f"IMAP error: {e}")
+            logging.error(f"IMAP error ({mailbox.name}): {e}")
         except Exception as e:
-            logging.error(f"Error in main_async loop: {e}")
-        
-        await asyncio.sleep(10)
+            logging.error(f"Error watching {mailbox.name}: {e}")
+        finally:
+            if mail is not None:
+                try:
+                    mail.logout()
+                except Exception:
+                    pass
+
+        if stopping.is_set():
+            break
+        # Only rapid-fire failures should escalate the delay
+        if time.monotonic() - started > MIN_SESSION_UPTIME:
+            backoff = 0
+        backoff = next_backoff(backoff)
+        logging.info(f"Reconnecting to email server of {mailbox.name} in {backoff} seconds.")
+        await sleep_unless_stopping(stopping, backoff)
+
+def log_slowest():
+    for entry in metrics.slowest.dump():
+        logging.info(f"Slow voicemail: {entry}")
+
+async def main_async(stopping=None):
+    """
+    Watch the mailboxes until stopping is set. Run on its own, it stops on SIGINT/SIGTERM and
+    serves its own metrics; under the supervisor, that takes care of both.
+    """
+    loop = asyncio.get_running_loop()
+    standalone = stopping is None
+    if standalone:
+        stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+        if METRICS_PORT:
+            metrics.start_server(METRICS_PORT, METRICS_HOST)
+    if metrics.slowest is not None:
+        # kill -USR1 writes the slowest recent voicemails to the log
+        loop.add_signal_handler(signal.SIGUSR1, log_slowest)
+
+    # Fail here rather than on the first voicemail when the Google key is missing or broken
+    await asyncio.to_thread(speech_client)
+
+    pipeline = Pipeline()
+    pipeline.start()
+    await asyncio.gather(*(watch_mailbox(mailbox, pipeline, stopping) for mailbox in MAILBOXES))
+    logging.info("Stopping, finishing the voicemails already in progress...")
+    await pipeline.drain(DRAIN_TIMEOUT)
+    if outbox is not None and standalone:
+        await outbox.aclose()
 
 if __name__ == "__main__":
     logging.info("Starting main_async loop.")
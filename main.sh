@@ -1,4 +1,3 @@
 #!bin/bash
-exec python3 main.py &
-exec python3 telegram_listener.py &
-exec python3 emailcleanup.py
\ No newline at end of file
+# One process runs main.py, telegram_listener.py and emailcleanup.py as tasks
+exec python3 supervisor.py
@@ -0,0 +1,180 @@
+"""
+Counters, gauges and histograms in the Prometheus text format, served over HTTP on a local port.
+
+Kept to what the voicemail scripts need, so no client library has to be installed. Metrics
+are module-level objects that register themselves; every script that imports this module
+exposes whatever it has recorded through start_server().
+"""
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# Seconds, from a cache lookup up to a recognition operation running into its timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+slowest = None
+# Returns {name: healthy} for /health, set by whoever supervises the process
+health = None
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+class Gauge:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # labels -> [count per bucket..., sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * len(self.buckets) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block took, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = [('le', _number(bound))]
+                    lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(counts[-1])}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+class SlowestMessages:
+    """Keeps the last `window` timed messages, to list the slowest `keep` of them."""
+    def __init__(self, keep=20, window=1000):
+        self.keep = keep
+        self.recent = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds, **details):
+        with self.lock:
+            self.recent.append(dict(details, seconds=round(seconds, 3)))
+
+    def dump(self):
+        with self.lock:
+            return sorted(self.recent, key=lambda entry: entry['seconds'], reverse=True)[:self.keep]
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        code = 200
+        if self.path == '/metrics':
+            body, content_type = render().encode(), 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/slowest' and slowest is not None:
+            body, content_type = json.dumps(slowest.dump(), indent=2).encode(), 'application/json'
+        elif self.path == '/health' and health is not None:
+            status = health()
+            body, content_type = json.dumps(status).encode(), 'application/json'
+            # 503 lets a container health check see a task that keeps crashing
+            if not all(status.values()):
+                code = 503
+        else:
+            self.send_error(404)
+            return
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the application log
+        pass
+
+def start_server(port, host='127.0.0.1'):
+    """Serve /metrics (and /slowest and /health when enabled) from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def track_slowest(keep, window=1000):
+    """Enable /slowest, listing the slowest of the recent messages."""
+    global slowest
+    slowest = SlowestMessages(keep, window)
+    return slowest
@@ -0,0 +1,76 @@
+"""
+Asynchronous client for the storingsdienst HTTP API of the PBX.
+
+Requests share a small pool of keep-alive connections, have connect and read timeouts and
+are retried a bounded number of times when the PBX cannot be reached. The active number is
+cached for a short while, so status questions do not each go to the PBX.
+"""
+import asyncio
+import logging
+import random
+import time
+import httpx
+
+class PBXClient:
+    def __init__(self, host, timeout=10, connect_timeout=3, retries=2, status_path="/storingsdienst/getnummer.php",
+                 status_ttl=30):
+        self.base_url = f"http://{host}"
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.retries = retries
+        self.status_path = status_path
+        self.status_ttl = status_ttl
+        self.client = None
+        # (number, time it was read)
+        self.status = None
+        self.status_lock = asyncio.Lock()
+
+    def _client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout,
+                                            limits=httpx.Limits(max_connections=4, max_keepalive_connections=2))
+        return self.client
+
+    async def get(self, path, params=None):
+        """GET path, retrying connection problems, timeouts and 5xx answers. Returns the response."""
+        for attempt in range(1, self.retries + 2):
+            try:
+                response = await self._client().get(path, params=params)
+                if response.status_code < 500 or attempt > self.retries:
+                    return response
+                logging.warning("PBX answered %d for %s (Attempt %d/%d)", response.status_code, path, attempt,
+                                self.retries + 1)
+            except httpx.TransportError as e:
+                if attempt > self.retries:
+                    raise
+                logging.warning("PBX request %s failed (Attempt %d/%d): %r", path, attempt, self.retries + 1, e)
+            await asyncio.sleep(0.5 * 2 ** attempt + random.random() * 0.5)
+
+    async def set_number(self, phone_number):
+        """Switch the storingsdienst to phone_number. Returns the response."""
+        response = await self.get("/storingsdienst/setnummer.php", params={"setnummer": phone_number})
+        if response.status_code == 200:
+            self.status = (phone_number, time.monotonic())
+        else:
+            self.status = None
+        return response
+
+    async def current_number(self):
+        """The number the storingsdienst is switched to, at most status_ttl seconds old."""
+        # Questions arriving together share one request
+        async with self.status_lock:
+            if self.status is not None and time.monotonic() - self.status[1] < self.status_ttl:
+                return self.status[0]
+            response = await self.get(self.status_path)
+            response.raise_for_status()
+            number = response.text.strip()
+            self.status = (number, time.monotonic())
+            return number
+
+    def forget_number(self):
+        """Read the number from the PBX again next time, after it was switched some other way."""
+        self.status = None
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
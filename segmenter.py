@@ -0,0 +1,117 @@
+"""
+Silence-aware splitting of voicemail audio for the speech API.
+
+Everything in here works on raw 16-bit mono PCM (LINEAR16) and has no side effects,
+so it can be tried out and timed without any Google or Telegram account.
+"""
+from array import array
+from collections import namedtuple
+import re
+import sys
+
+SAMPLE_WIDTH = 2
+
+# pcm is the audio to transcribe, start_ms/end_ms its position in the recording.
+# overlapped is True when the segment starts before the previous one ended.
+Segment = namedtuple('Segment', ['pcm', 'start_ms', 'end_ms', 'overlapped'])
+
+_WORD = re.compile(r"\w+")
+
+def _samples(pcm):
+    samples = array('h')
+    samples.frombytes(bytes(pcm[:len(pcm) - len(pcm) % SAMPLE_WIDTH]))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples
+
+def _peak(samples, start, end):
+    if start >= end:
+        return 0
+    window = samples[start:end]
+    return max(max(window), -min(window))
+
+def _find_cut(samples, low, high, window, threshold):
+    """
+    Search [low, high) backwards for the latest silent window and return (cut, silent).
+    Without silence the cut goes in the quietest window.
+    """
+    quietest, quietest_peak = high, None
+    position = high - window
+    while position >= low:
+        peak = _peak(samples, position, position + window)
+        if peak < threshold:
+            return position + window // 2, True
+        if quietest_peak is None or peak < quietest_peak:
+            quietest, quietest_peak = position + window // 2, peak
+        position -= window
+    return quietest, False
+
+def split_pcm(pcm, sample_rate, max_ms=59000, search_ms=20000, window_ms=50,
+              silence_thresh=-40.0, overlap_ms=0, padding_ms=250):
+    """
+    Split PCM into segments of at most max_ms, cutting in a silence within the last search_ms
+    before the limit. Leading and trailing silence is trimmed (keeping padding_ms) and segments
+    without any sound are left out, so they never cost a recognition request. When a cut has to be
+    made in the middle of speech, the next segment starts overlap_ms earlier so no word is lost;
+    use stitch_transcripts() to remove the words both segments then contain.
+    """
+    samples = _samples(pcm)
+    per_ms = sample_rate / 1000
+    window = max(1, int(window_ms * per_ms))
+    max_len = int(max_ms * per_ms)
+    search = min(int(search_ms * per_ms), max_len - window)
+    overlap = min(int(overlap_ms * per_ms), max_len - search - 1)
+    threshold = int(32768 * 10 ** (silence_thresh / 20))
+
+    start, end = 0, len(samples)
+    while start < end and _peak(samples, start, start + window) < threshold:
+        start += window
+    while end > start and _peak(samples, max(start, end - window), end) < threshold:
+        end -= window
+    if start >= end:
+        return []
+    padding = int(padding_ms * per_ms)
+    start, end = max(0, start - padding), min(len(samples), end + padding)
+
+    bounds = []
+    overlapped = False
+    while end - start > max_len:
+        cut, silent = _find_cut(samples, start + max_len - search, start + max_len, window, threshold)
+        bounds.append((start, cut, overlapped))
+        overlapped = not silent and overlap > 0
+        start = cut - overlap if overlapped else cut
+    bounds.append((start, end, overlapped))
+
+    segments = []
+    for start, end, overlapped in bounds:
+        if _peak(samples, start, end) < threshold:
+            continue
+        segments.append(Segment(
+            pcm=bytes(pcm[start * SAMPLE_WIDTH:end * SAMPLE_WIDTH]),
+            start_ms=int(start / per_ms),
+            end_ms=int(end / per_ms),
+            overlapped=overlapped and bool(segments),
+        ))
+    return segments
+
+def _normalize(word):
+    return "".join(_WORD.findall(word.lower()))
+
+def _overlap(left, right, limit):
+    for n in range(min(limit, len(left), len(right)), 0, -1):
+        if [_normalize(w) for w in left[-n:]] == [_normalize(w) for w in right[:n]]:
+            return n
+    return 0
+
+def stitch_transcripts(texts, overlapped, max_overlap_words=8):
+    """
+    Join segment transcripts in order. Where a segment overlapped the previous one, the
+    words at its start that repeat the end of the previous transcript are dropped.
+    """
+    words = []
+    for text, has_overlap in zip(texts, overlapped):
+        next_words = text.split()
+        if has_overlap and words:
+            next_words = next_words[_overlap(words, next_words, max_overlap_words):]
+        words.extend(next_words)
+    return " ".join(words)
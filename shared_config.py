@@ -0,0 +1,28 @@
+"""
+Where main.py, telegram_listener.py, emailcleanup.py and supervisor.py find their config,
+data and log directories, and the config.ini they all read.
+
+VOICEMAIL_CONFIG_DIR, VOICEMAIL_DATA_DIR and VOICEMAIL_LOG_DIR move the directories, for every
+component alike. config.ini is read once per process, so the components supervisor.py runs
+share one ConfigParser and cannot end up on different files.
+"""
+import configparser
+import os
+from pathlib import Path
+
+base_dir = Path(__file__).resolve().parent
+config_dir = Path(os.environ.get('VOICEMAIL_CONFIG_DIR', base_dir / 'config'))
+data_dir = Path(os.environ.get('VOICEMAIL_DATA_DIR', base_dir / 'data'))
+log_dir = Path(os.environ.get('VOICEMAIL_LOG_DIR', base_dir / 'logs'))
+config_file = config_dir / 'config.ini'
+
+_config = None
+
+def load_config():
+    """The parsed config.ini, read on the first call."""
+    global _config
+    if _config is None:
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        _config = config
+    return _config
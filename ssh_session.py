@@ -0,0 +1,97 @@
+"""
+One long-lived SSH connection to the PBX, with a channel per command.
+
+The connection is made on first use and kept alive with SSH keepalives. When it drops,
+the next command reconnects. Commands block, so call run() from a thread.
+"""
+import logging
+import socket
+import threading
+import time
+import paramiko
+
+class CommandTimeout(socket.timeout):
+    """The command started but did not finish in time. It may still be running on the other side."""
+
+class SSHSession:
+    def __init__(self, host, port, username, password, keepalive=30, connect_timeout=15):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.client = None
+        self.lock = threading.Lock()
+
+    def _transport(self):
+        with self.lock:
+            transport = self.client.get_transport() if self.client is not None else None
+            if transport is not None and transport.is_active():
+                return transport
+
+            self._close()
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            logging.info("Connecting to %s:%d over SSH", self.host, self.port)
+            client.connect(self.host, self.port, self.username, self.password,
+                           timeout=self.connect_timeout, banner_timeout=self.connect_timeout,
+                           auth_timeout=self.connect_timeout)
+            transport = client.get_transport()
+            # Without traffic a NAT or firewall on the way may drop the connection silently
+            transport.set_keepalive(self.keepalive)
+            self.client = client
+            return transport
+
+    def run(self, command, timeout):
+        """
+        Run command in a new channel and wait at most timeout seconds for it.
+        Returns (exit_status, stdout, stderr). Raises CommandTimeout when the command
+        takes longer; the channel is closed then.
+        """
+        try:
+            channel = self._transport().open_session(timeout=self.connect_timeout)
+            try:
+                return self._wait(channel, command, timeout)
+            finally:
+                channel.close()
+        except socket.timeout:
+            raise
+        except (paramiko.SSHException, EOFError, OSError):
+            # Leave a broken connection for the next attempt to replace
+            self.close()
+            raise
+
+    def _wait(self, channel, command, timeout):
+        stdout, stderr = bytearray(), bytearray()
+        channel.exec_command(command)
+        deadline = time.monotonic() + timeout
+        while True:
+            # Keep reading, a command that fills the channel window would never exit
+            while channel.recv_ready():
+                stdout += channel.recv(32768)
+            while channel.recv_stderr_ready():
+                stderr += channel.recv_stderr(32768)
+            if channel.exit_status_ready():
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise CommandTimeout(f"Command did not finish within {timeout} seconds")
+            channel.status_event.wait(min(remaining, 0.2))
+        exit_status = channel.recv_exit_status()
+        # Output that arrived together with the exit status
+        while channel.recv_ready():
+            stdout += channel.recv(32768)
+        while channel.recv_stderr_ready():
+            stderr += channel.recv_stderr(32768)
+        return exit_status, bytes(stdout), bytes(stderr)
+
+    def _close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def close(self):
+        with self.lock:
+            self._close()
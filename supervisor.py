@@ -0,0 +1,127 @@
+"""
+Runs the voicemail notifier (main.py), the Telegram command listener (telegram_listener.py)
+and the mailbox cleanup (emailcleanup.py) as tasks in one asyncio process, instead of three
+interpreters started side by side.
+
+Logging is set up once and the components share one config (shared_config.py), one Telegram
+Bot with its connection pool, and one outbox (telegram_outbox.py) that keeps their messages
+within Telegram's rate limits.
+Each component is imported when its task starts, and restarted with backoff when it crashes.
+The metrics port serves the metrics of all three, and /health shows which tasks are running.
+"""
+import asyncio
+import logging
+import signal
+import time
+import metrics
+import shared_config
+from telegram_outbox import Outbox
+
+# Set up logging directory and file, for all components
+log_dir = shared_config.log_dir
+log_dir.mkdir(exist_ok=True)
+log_file = log_dir / 'voicemail.log'
+
+# The components' own logging.basicConfig() calls do nothing once this has run
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.StreamHandler(),
+        logging.FileHandler(log_file)
+    ]
+)
+# Every poll for Telegram updates would be logged
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Read once here; the components get the same ConfigParser from shared_config
+config = shared_config.load_config()
+
+TELEGRAM_TOKEN = config['secrets']['TELEGRAMTOKEN']
+METRICS_PORT = config.getint('settings', 'METRICSPORT', fallback=0)
+METRICS_HOST = config.get('settings', 'METRICSHOST', fallback='127.0.0.1')
+TELEGRAM_POOL_SIZE = 8
+MAX_BACKOFF = 300
+MIN_TASK_UPTIME = 60
+
+task_up = metrics.Gauge('supervisor_task_up', 'Whether a supervised task is running.', ['task'])
+restarts_total = metrics.Counter('supervisor_restarts_total', 'Restarts of supervised tasks.', ['task'])
+# task name -> running
+running = {}
+
+async def run_notifier(stopping, bot, outbox):
+    import main
+    main.bot = bot
+    main.outbox = outbox
+    await main.main_async(stopping)
+
+async def run_listener(stopping, bot, outbox):
+    import telegram_listener
+    await telegram_listener.run(stopping, bot, outbox)
+
+async def run_cleanup(stopping, bot, outbox):
+    import emailcleanup
+    await emailcleanup.run(stopping)
+
+TASKS = {
+    'notifier': run_notifier,
+    'listener': run_listener,
+    'cleanup': run_cleanup,
+}
+
+async def supervise(name, component, stopping, bot, outbox):
+    """Run component until stopping is set, restarting it with backoff whenever it crashes or returns."""
+    backoff = 0
+    while not stopping.is_set():
+        started = time.monotonic()
+        running[name] = True
+        task_up.set(1, task=name)
+        try:
+            await component(stopping, bot, outbox)
+            if stopping.is_set():
+                break
+            logging.error(f"Task {name} stopped unexpectedly.")
+        except Exception as e:
+            logging.error(f"Task {name} crashed: {type(e).__name__}: {e}")
+        running[name] = False
+        task_up.set(0, task=name)
+
+        # Only rapid-fire crashes should escalate the delay
+        if time.monotonic() - started > MIN_TASK_UPTIME:
+            backoff = 0
+        backoff = min(backoff * 2, MAX_BACKOFF) if backoff else 5
+        restarts_total.inc(task=name)
+        logging.info(f"Restarting task {name} in {backoff} seconds.")
+        try:
+            await asyncio.wait_for(stopping.wait(), backoff)
+        except asyncio.TimeoutError:
+            pass
+    running[name] = False
+    task_up.set(0, task=name)
+
+async def main_async():
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    metrics.health = lambda: dict(running)
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT, METRICS_HOST)
+
+    bot = Bot(token=TELEGRAM_TOKEN, request=HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE))
+    # One queue for both, so together they stay within Telegram's rate limits
+    outbox = Outbox.from_config(bot, config)
+    try:
+        await asyncio.gather(*(supervise(name, component, stopping, bot, outbox) for name, component in TASKS.items()))
+    finally:
+        await outbox.aclose()
+        await bot.shutdown()
+    logging.info("All tasks stopped.")
+
+if __name__ == "__main__":
+    logging.info("Starting supervisor.")
+    asyncio.run(main_async())
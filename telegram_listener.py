@@ -1,21 +1,25 @@
 import logging
-import paramiko
 import configparser
-import requests
+import httpx
 from telegram import Update, Bot
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from pathlib import Path
-import json
 import asyncio
 import nest_asyncio
 import select
 import time
+from collections import defaultdict
+import metrics
+from ssh_session import CommandTimeout, SSHSession
+from pbx_client import PBXClient
+from customer_index import FileCache, load_customers, load_text
+from telegram_outbox import Outbox
+import shared_config
 
 # Apply the nest_asyncio patch
 nest_asyncio.apply()
 
 # Set up logging directory and file
-log_dir = Path(__file__).resolve().parent / 'logs'
+log_dir = shared_config.log_dir
 log_dir.mkdir(exist_ok=True)
 log_file = log_dir / 'telegram_listener.log'
 
@@ -30,8 +34,8 @@ logging.basicConfig(
 )
 
 # Define the configuration file paths
-config_dir = Path(__file__).resolve().parent / 'config'
-config_file = config_dir / 'config.ini'
+config_dir = shared_config.config_dir
+config_file = shared_config.config_file
 phone_numbers_file = config_dir / 'phone_numbers.ini'
 info_file = config_dir / 'info.txt'
 customers_file = config_dir / 'customers.json'
@@ -40,33 +44,100 @@ customers_file = config_dir / 'customers.json'
 if not config_file.is_file() or not phone_numbers_file.is_file() or not info_file.is_file() or not customers_file.is_file():
     raise FileNotFoundError("One or more configuration files are missing.")
 
-# Read configuration
-config = configparser.ConfigParser()
-config.read(config_file)
-config.read(phone_numbers_file)
+# Kept in memory and reloaded when the file changes
+customers = FileCache(customers_file, load_customers)
+info_text = FileCache(info_file, load_text)
+
+# Read configuration; the phone numbers in a parser of their own, config is shared with the other components
+config = shared_config.load_config()
+phone_numbers = configparser.ConfigParser()
+phone_numbers.read(phone_numbers_file)
 
 # Extract configuration values
 try:
     TELEGRAM_TOKEN = config['secrets']['TELEGRAMTOKEN']
     PBXIP = config['secrets']['PBXIP']
-    PHONE_NUMBERS = dict(config['PhoneNumbers'])
+    PHONE_NUMBERS = dict(phone_numbers['PhoneNumbers'])
 except KeyError as e:
     logging.error("Missing configuration value: %s", e)
     raise
 
+# Metrics are served on the port after main.py's, when METRICSPORT is set
+METRICS_PORT = config.getint('settings', 'METRICSPORT', fallback=0)
+METRICS_HOST = config.get('settings', 'METRICSHOST', fallback='127.0.0.1')
+
+ssh_seconds = metrics.Histogram('listener_ssh_command_seconds', 'SSH commands on the PBX, per attempt.', ['outcome'])
+pbx_seconds = metrics.Histogram('listener_pbx_request_seconds', 'HTTP requests to the PBX.')
+retries_total = metrics.Counter('listener_retries_total', 'Failed attempts that were retried.', ['op'])
+
+# SSH settings, all optional
+SSH_TIMEOUT = config.getint('settings', 'SSHTIMEOUT', fallback=60)
+SSH_KEEPALIVE = config.getint('settings', 'SSHKEEPALIVE', fallback=30)
+ssh_session = None
+
+def get_ssh_session():
+    """The SSH connection to the PBX, shared by all commands. It connects on first use."""
+    global ssh_session
+    if ssh_session is None:
+        ssh_session = SSHSession(config['secrets']['SSH_HOST'],
+                                 int(config['secrets']['SSH_PORT']),
+                                 config['secrets']['SSH_USERNAME'],
+                                 config['secrets']['SSH_PASSWORD'],
+                                 keepalive=SSH_KEEPALIVE)
+    return ssh_session
+
+# Updates are handled concurrently, at most this many at a time
+CONCURRENT_UPDATES = config.getint('settings', 'CONCURRENTUPDATES', fallback=8)
+
+# Commands that change the same thing on the PBX ("storingsdienst", "voicemail") run one at a time.
+# asyncio.Lock wakes waiters first come first served, so they run in the order they came in.
+resource_locks = defaultdict(asyncio.Lock)
+
+# PBX HTTP settings, all optional
+pbx = PBXClient(PBXIP,
+                timeout=config.getfloat('settings', 'PBXTIMEOUT', fallback=10),
+                connect_timeout=config.getfloat('settings', 'PBXCONNECTTIMEOUT', fallback=3),
+                retries=config.getint('settings', 'PBXRETRIES', fallback=2),
+                status_path=config.get('settings', 'PBXSTATUSPATH', fallback='/storingsdienst/getnummer.php'),
+                status_ttl=config.getint('settings', 'PBXSTATUSTTL', fallback=30))
+
+# Everything is sent through the outbox, shared with main.py under the supervisor
+outbox = None
+
+async def reply(update: Update, text: str) -> None:
+    """Answer update's message through the outbox, quoting it outside private chats like reply_text() does."""
+    message = update.message
+    reply_to = message.message_id if message.chat.type != "private" else None
+    await outbox.send("send_message", message.chat_id, text=text, reply_to_message_id=reply_to)
+
 # General function for setting storingsdienst
 async def set_storingsdienst(name: str, phone_number: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
+    async with resource_locks["storingsdienst"]:
+        try:
+            with pbx_seconds.time():
+                response = await pbx.set_number(phone_number)
+            if response.status_code == 200:
+                await reply(update, f"Storingsdienst naar {name}")
+            else:
+                await reply(update, "Er is een fout opgetreden.")
+                logging.error("Failed to set storingsdienst for %s: %s", name, response.text)
+        except httpx.HTTPError as e:
+            await reply(update, "Er is een fout opgetreden.")
+            logging.error("Exception while setting storingsdienst for %s: %s", name, e)
+
+async def storingsdienst_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        response = requests.get(f"http://{PBXIP}/storingsdienst/setnummer.php?setnummer={phone_number}")
-        if response.status_code == 200:
-            await update.message.reply_text(f"Storingsdienst naar {name}")
+        with pbx_seconds.time():
+            phone_number = await pbx.current_number()
+        name = next((name.capitalize() for name, number in PHONE_NUMBERS.items() if number == phone_number), None)
+        if name:
+            await reply(update, f"Storingsdienst staat op {name} ({phone_number})")
         else:
-            await update.message.reply_text("Er is een fout opgetreden.")
-            logging.error("Failed to set storingsdienst for %s: %s", name, response.text)
-    except requests.RequestException as e:
-        await update.message.reply_text("Er is een fout opgetreden.")
-        logging.error("Exception while setting storingsdienst for %s: %s", name, e)
+            await reply(update, f"Storingsdienst staat op {phone_number}")
+    except httpx.HTTPError as e:
+        await reply(update, "Er is een fout opgetreden bij het ophalen van de storingsdienst.")
+        logging.error("Exception while reading storingsdienst: %s", e)
 
 async def handle_storingsdienst_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
@@ -76,137 +147,200 @@ async def handle_storingsdienst_command(update: Update, context: ContextTypes.DE
         if phone_number:
             await set_storingsdienst(name, phone_number, update, context)
         else:
-            await update.message.reply_text("Onbekend commando.")
+            await reply(update, "Onbekend commando.")
             logging.warning("Unknown command received: %s", command)
     except Exception as e:
-        await update.message.reply_text("Er is een fout opgetreden bij het verwerken van het commando.")
+        await reply(update, "Er is een fout opgetreden bij het verwerken van het commando.")
         logging.error("Error handling storingsdienst command: %s", e)
 
-async def execute_ssh_command(command: str, success_message: str, error_message: str, chat_id: int, bot: Bot, retries: int = 3) -> None:
-    ssh_client = paramiko.SSHClient()
-    ssh_client.load_system_host_keys()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
+async def execute_ssh_command(command: str, success_message: str, error_message: str, chat_id: int, retries: int = 3) -> None:
     for attempt in range(1, retries + 1):
+        started = time.monotonic()
+        outcome = "error"
         try:
             logging.info("Attempting to execute SSH command (Attempt %d/%d): %s", attempt, retries, command)
-            ssh_client.connect(config['secrets']['SSH_HOST'], 
-                               int(config['secrets']['SSH_PORT']), 
-                               config['secrets']['SSH_USERNAME'], 
-                               config['secrets']['SSH_PASSWORD'])
 
-            # Set a timeout for the command execution
-            stdin, stdout, stderr = ssh_client.exec_command(command, timeout=60)
-            
-            logging.info("Command started, waiting for completion...")
-            
-            # Wait for the command to complete with timeout
-            exit_status = stdout.channel.recv_exit_status()
-            
+            # The command runs in its own thread, so other chat commands are handled meanwhile
+            exit_status, _, error_output = await asyncio.to_thread(get_ssh_session().run, command, SSH_TIMEOUT)
+
             logging.info("Command completed with exit status: %d", exit_status)
+            outcome = "success" if exit_status == 0 else "failed"
+            ssh_seconds.observe(time.monotonic() - started, outcome=outcome)
             
             # If exit status is 0, immediately send success message
             if exit_status == 0:
                 logging.info("SSH command executed successfully on attempt %d", attempt)
                 logging.info("Sending success message to chat %d", chat_id)
-                await bot.send_message(chat_id=chat_id, text=success_message)
+                await outbox.send("send_message", chat_id, text=success_message)
                 logging.info("Success message sent successfully")
                 break
             else:
-                # Only read stderr if there was an error
-                error_output = stderr.read()
                 logging.error("SSH command failed with exit status %d on attempt %d: %s", exit_status, attempt, error_output)
                 if attempt == retries:
                     logging.info("Sending error message to chat %d", chat_id)
-                    await bot.send_message(chat_id=chat_id, text=error_message)
+                    await outbox.send("send_message", chat_id, text=error_message)
                     
+        except CommandTimeout as e:
+            # The command may still be running on the PBX, starting it again could run it twice
+            outcome = "timeout"
+            logging.error("SSH command timed out on attempt %d, not retrying: %s", attempt, e)
+            await outbox.send("send_message", chat_id,
+                              text=f"Geen antwoord van de PBX binnen {SSH_TIMEOUT} seconden, het commando kan nog "
+                                   "bezig zijn. Controleer het resultaat voordat je het opnieuw probeert.")
+            break
         except Exception as e:
             logging.error("Exception during SSH command execution on attempt %d: %s", attempt, str(e))
             logging.error("Exception type: %s", type(e).__name__)
             if attempt == retries:
                 logging.info("Sending exception message to chat %d", chat_id)
-                await bot.send_message(chat_id=chat_id, text=f"Error: {type(e).__name__}: {str(e)}")
+                await outbox.send("send_message", chat_id, text=f"Error: {type(e).__name__}: {str(e)}")
         finally:
-            ssh_client.close()
+            if outcome in ("error", "timeout"):
+                ssh_seconds.observe(time.monotonic() - started, outcome=outcome)
+            if outcome in ("error", "failed") and attempt < retries:
+                retries_total.inc(op="ssh")
 
 async def delete_vm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type == "group":
         chat_id = update.message.chat_id
-        await execute_ssh_command("rm -f /var/spool/asterisk/voicemail/default/9001/INBOX/*.*",
-                                  "Voicemail verwijderd.",
-                                  "Probleem bij verwijderen voicemail.",
-                                  chat_id, context.bot, retries=3)
+        async with resource_locks["voicemail"]:
+            await execute_ssh_command("rm -f /var/spool/asterisk/voicemail/default/9001/INBOX/*.*",
+                                      "Voicemail verwijderd.",
+                                      "Probleem bij verwijderen voicemail.",
+                                      chat_id, retries=3)
 
 async def vivia(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type == "group":
         chat_id = update.message.chat_id
-        await execute_ssh_command("/var/lib/misc/vivia/vivia.sh",
-                                  "Storingsdienst naar Vivia",
-                                  "Probleem bij omzetten storingsdienst",
-                                  chat_id, context.bot, retries=3)
+        async with resource_locks["storingsdienst"]:
+            await execute_ssh_command("/var/lib/misc/vivia/vivia.sh",
+                                      "Storingsdienst naar Vivia",
+                                      "Probleem bij omzetten storingsdienst",
+                                      chat_id, retries=3)
+            # The script switches the PBX itself, so what was read before no longer holds
+            pbx.forget_number()
 
 async def avics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type == "group":
         chat_id = update.message.chat_id
-        await execute_ssh_command("/var/lib/misc/avics/avics.sh",
-                                  "Storingsdienst naar Avics",
-                                  "Probleem bij omzetten storingsdienst",
-                                  chat_id, context.bot, retries=3)
+        async with resource_locks["storingsdienst"]:
+            await execute_ssh_command("/var/lib/misc/avics/avics.sh",
+                                      "Storingsdienst naar Avics",
+                                      "Probleem bij omzetten storingsdienst",
+                                      chat_id, retries=3)
+            # The script switches the PBX itself, so what was read before no longer holds
+            pbx.forget_number()
 
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == "group":
         try:
-            with open(info_file, "r") as file:
-                info = file.read()
-            await update.message.reply_text(info)
+            await reply(update, info_text.get())
         except Exception as e:
-            await update.message.reply_text("Er is een fout opgetreden bij het ophalen van de informatie.")
+            await reply(update, "Er is een fout opgetreden bij het ophalen van de informatie.")
             logging.error("Error reading info file: %s", e)
 
 async def handle_customer_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     command = update.message.text[1:].lower()  # Extract the command name
-    # Load customer information dynamically from JSON file
-    with open(customers_file, 'r') as file:
-        CUSTOMERS = json.load(file)
-    customer_info = CUSTOMERS.get(command)
+    customer_info = customers.get().get(command)
     if customer_info:
         formatted_message = customer_info.replace('\n', '\n')
-        await update.message.reply_text(formatted_message)
+        await reply(update, formatted_message)
     else:
-        await update.message.reply_text("Onbekend commando, zie /info of /klant")
+        await reply(update, "Onbekend commando, zie /info of /klant")
         logging.warning("Unknown customer command received: %s", command)
 
+async def search_customers(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = " ".join(context.args)
+    if not query:
+        # Without a query /klant is answered from customers.json like any other command
+        await handle_customer_command(update, context)
+        return
+    try:
+        index = customers.get()
+        matches = index.search(query)
+        if not matches:
+            await reply(update, f"Geen klant gevonden voor \"{query}\"")
+        elif len(matches) == 1:
+            await reply(update, index.get(matches[0]))
+        else:
+            await reply(update, "\n".join(f"/{command}" for command in matches))
+    except Exception as e:
+        await reply(update, "Er is een fout opgetreden bij het zoeken.")
+        logging.error("Error searching customers for %s: %s", query, e)
+
 async def lol(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.chat.type == "group":
         chat_id = update.message.chat_id
-        await context.bot.send_message(chat_id=chat_id, text="https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+        await outbox.send("send_message", chat_id, text="https://www.youtube.com/watch?v=dQw4w9WgXcQ")
 
 async def handle_other_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     pass
 
+async def close_clients(application: Application) -> None:
+    await pbx.aclose()
+    await outbox.aclose()
+
+def build_application(bot: Bot = None, shared_outbox: Outbox = None) -> Application:
+    """
+    The bot application with all command handlers. With bot and shared_outbox, it sends
+    through that shared Bot and outbox.
+    """
+    global outbox
+    builder = Application.builder()
+    builder = builder.bot(bot) if bot is not None else builder.token(TELEGRAM_TOKEN)
+    application = builder.post_shutdown(close_clients).concurrent_updates(CONCURRENT_UPDATES).build()
+    outbox = shared_outbox if shared_outbox is not None else Outbox.from_config(application.bot, config)
+
+    # Register the command handlers
+    application.add_handler(CommandHandler("deletevm", delete_vm))
+    application.add_handler(CommandHandler("vivia", vivia))
+    application.add_handler(CommandHandler("avics", avics))
+    for cmd in PHONE_NUMBERS.keys():
+        application.add_handler(CommandHandler(cmd, handle_storingsdienst_command))
+    application.add_handler(CommandHandler("storingsdienst", storingsdienst_status))
+    application.add_handler(CommandHandler("info", info))
+    application.add_handler(CommandHandler("klant", search_customers))
+    application.add_handler(CommandHandler("lol", lol))
+
+    # Register a generic handler for all customer commands
+    application.add_handler(MessageHandler(filters.COMMAND, handle_customer_command))
+
+    # Register a message handler for all other text messages in the group chat
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_other_messages))
+    return application
+
+async def run(stopping: asyncio.Event, bot: Bot = None, shared_outbox: Outbox = None) -> None:
+    """Poll for updates until stopping is set. This is how the supervisor runs the listener."""
+    application = build_application(bot, shared_outbox)
+    try:
+        await application.initialize()
+        await application.start()
+        await application.updater.start_polling()
+        await stopping.wait()
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        if bot is None:
+            await application.shutdown()
+        else:
+            # Application.shutdown() would also close the shared Bot, which main.py still sends with
+            await application.updater.shutdown()
+        # run_polling() calls post_shutdown, here it is up to us
+        await pbx.aclose()
+        if shared_outbox is None:
+            await outbox.aclose()
+
 async def main() -> None:
     try:
-        # Initialize the Telegram Bot
-        bot = Bot(token=TELEGRAM_TOKEN)
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
-        
+        if METRICS_PORT:
+            metrics.start_server(METRICS_PORT + 1, METRICS_HOST)
+
+        application = build_application()
+
         # Initialize application
         await application.initialize()
-        
-        # Register the command handlers
-        application.add_handler(CommandHandler("deletevm", delete_vm))
-        application.add_handler(CommandHandler("vivia", vivia))
-        application.add_handler(CommandHandler("avics", avics))
-        for cmd in PHONE_NUMBERS.keys():
-            application.add_handler(CommandHandler(cmd, handle_storingsdienst_command))
-        application.add_handler(CommandHandler("info", info))
-        application.add_handler(CommandHandler("lol", lol))
-
-        # Register a generic handler for all customer commands
-        application.add_handler(MessageHandler(filters.COMMAND, handle_customer_command))
-
-        # Register a message handler for all other text messages in the group chat
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_other_messages))
 
         # Start polling for updates
         await application.run_polling()
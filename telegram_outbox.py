@@ -0,0 +1,219 @@
+"""
+One queue for everything sent to Telegram, shared by the voicemail notifier and the listener.
+
+Telegram allows about one message a second in a private chat, 20 a minute in a group and 30 a
+second over all chats. Rather than running into those limits and waiting out RetryAfter, a
+request waits for a token from its chat's bucket and from the global bucket before it is sent.
+Requests to one chat go out one at a time, in order, with the LIVE lane ahead of the BULK lane.
+Small text messages waiting for the same chat are sent as one.
+"""
+from collections import deque
+import asyncio
+import logging
+import random
+import time
+from telegram.error import BadRequest, NetworkError, RetryAfter
+import metrics
+
+LIVE = 0
+BULK = 1
+LANES = {LIVE: "live", BULK: "bulk"}
+MAX_MESSAGE_LENGTH = 4096
+
+telegram_seconds = metrics.Histogram('voicemail_telegram_seconds', 'Telegram API calls, per attempt.', ['method'])
+queue_seconds = metrics.Histogram('voicemail_telegram_queue_seconds', 'Time a Telegram request waited in the outbox.',
+                                  ['lane'])
+retries_total = metrics.Counter('voicemail_telegram_retries_total', 'Telegram requests retried after a network error.')
+retry_after_total = metrics.Counter('voicemail_telegram_retry_after_total', 'RetryAfter responses from Telegram.')
+retry_after_seconds = metrics.Counter('voicemail_telegram_retry_after_seconds_total', 'Time spent waiting out RetryAfter.')
+merged_total = metrics.Counter('voicemail_telegram_merged_total', 'Text messages sent together with the one before them.')
+
+class TokenBucket:
+    """rate tokens a second, of which at most burst are saved up."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class _Request:
+    def __init__(self, method, kwargs, lane):
+        self.method = method
+        self.kwargs = kwargs
+        self.lane = lane
+        # More than one when messages were merged
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.queued = time.monotonic()
+        self.attempt = 0
+
+    def abandoned(self):
+        return all(future.done() for future in self.futures)
+
+class _Chat:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.lanes = {lane: deque() for lane in LANES}
+        self.busy = False
+        # Held back until then after RetryAfter or a network error
+        self.not_before = 0
+
+class Outbox:
+    def __init__(self, bot, chat_rate=1, group_rate=20 / 60, global_rate=30, burst=3, max_attempts=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chats = {}
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.sending = set()
+
+    @classmethod
+    def from_config(cls, bot, config):
+        """An outbox with the limits from the [settings] section, in messages a minute except the global one."""
+        return cls(bot,
+                   chat_rate=config.getfloat('settings', 'TELEGRAMCHATRATE', fallback=60) / 60,
+                   group_rate=config.getfloat('settings', 'TELEGRAMGROUPRATE', fallback=20) / 60,
+                   global_rate=config.getfloat('settings', 'TELEGRAMGLOBALRATE', fallback=30),
+                   burst=config.getint('settings', 'TELEGRAMBURST', fallback=3))
+
+    async def send(self, method, chat_id, lane=LIVE, **kwargs):
+        """
+        Queue bot.<method>(chat_id=chat_id, **kwargs) and wait for its result. Network errors are
+        retried up to max_attempts; other errors, and the last network error, are raised.
+        """
+        key = str(chat_id)
+        chat = self.chats.get(key)
+        if chat is None:
+            # Group and channel ids are negative, channels may also be given as @name
+            rate = self.group_rate if key.startswith(("-", "@")) else self.chat_rate
+            chat = self.chats[key] = _Chat(TokenBucket(rate, self.burst))
+        request = _Request(method, dict(kwargs, chat_id=chat_id), lane)
+        chat.lanes[lane].append(request)
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        self.wakeup.set()
+        return await request.futures[0]
+
+    async def _dispatch(self):
+        while True:
+            self.wakeup.clear()
+            delay = self._start_ready()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_ready(self):
+        """Start the requests the limits allow now. Returns the seconds until the next may be, or None."""
+        now = time.monotonic()
+        delay = None
+        for lane in LANES:
+            for chat in self.chats.values():
+                waiting = chat.lanes[lane]
+                while waiting and waiting[0].abandoned():
+                    waiting.popleft()
+                if chat.busy or not waiting:
+                    continue
+                wait = max(chat.not_before - now, chat.bucket.wait_time(now), self.global_bucket.wait_time(now))
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                request = waiting.popleft()
+                self._merge(request, waiting)
+                chat.bucket.take()
+                self.global_bucket.take()
+                chat.busy = True
+                task = asyncio.create_task(self._send(chat, request))
+                self.sending.add(task)
+                task.add_done_callback(self.sending.discard)
+        return delay
+
+    def _merge(self, request, waiting):
+        """Add the text of messages queued right behind request, as long as it stays one message."""
+        if request.method != "send_message":
+            return
+        others = {name: value for name, value in request.kwargs.items() if name != "text"}
+        while waiting and waiting[0].method == "send_message":
+            following = waiting[0]
+            if {name: value for name, value in following.kwargs.items() if name != "text"} != others:
+                break
+            text = request.kwargs["text"] + "\n\n" + following.kwargs["text"]
+            if len(text) > MAX_MESSAGE_LENGTH:
+                break
+            waiting.popleft()
+            if following.abandoned():
+                continue
+            request.kwargs = dict(request.kwargs, text=text)
+            request.futures.extend(following.futures)
+            merged_total.inc()
+
+    async def _send(self, chat, request):
+        if request.attempt == 0:
+            queue_seconds.observe(time.monotonic() - request.queued, lane=LANES[request.lane])
+        request.attempt += 1
+        try:
+            with telegram_seconds.time(method=request.method):
+                result = await getattr(self.bot, request.method)(**request.kwargs)
+        except RetryAfter as e:
+            # Not counted as an attempt: Telegram said when to come back
+            logging.warning("Rate limited by Telegram in chat %s, holding it for %s seconds", request.kwargs["chat_id"],
+                            e.retry_after)
+            retry_after_total.inc()
+            retry_after_seconds.inc(e.retry_after)
+            request.attempt -= 1
+            chat.not_before = time.monotonic() + e.retry_after
+            chat.lanes[request.lane].appendleft(request)
+        except BadRequest as e:
+            # A NetworkError as well, but sending it again gives the same answer
+            self._fail(request, e)
+        except NetworkError as e:
+            if request.attempt < self.max_attempts:
+                wait_time = min(60, 2 ** request.attempt + random.random() * request.attempt)
+                logging.error("NetworkError: %s, retrying in %.1f seconds... (Attempt %d/%d)", e, wait_time,
+                              request.attempt, self.max_attempts)
+                retries_total.inc()
+                # Later requests to the chat wait as well, so they do not overtake this one
+                chat.not_before = time.monotonic() + wait_time
+                chat.lanes[request.lane].appendleft(request)
+            else:
+                self._fail(request, e)
+        except Exception as e:
+            self._fail(request, e)
+        else:
+            for future in request.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            chat.busy = False
+            self.wakeup.set()
+
+    def _fail(self, request, error):
+        for future in request.futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def aclose(self):
+        """Stop sending. Requests still queued are cancelled."""
+        for chat in self.chats.values():
+            for waiting in chat.lanes.values():
+                for request in waiting:
+                    for future in request.futures:
+                        future.cancel()
+                waiting.clear()
+        tasks = list(self.sending) + ([self.dispatcher] if self.dispatcher is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.dispatcher = None
@@ -0,0 +1,196 @@
+"""
+The hand-written parsers, against FETCH responses in the shape Dovecot and Gmail send them.
+
+Responses are replayed through imaplib itself, so literals are split up exactly as they are
+when main.py talks to a real server. Run with python -m pytest tests.
+"""
+from array import array
+from datetime import date, datetime, timezone
+from pathlib import Path
+import base64
+import imaplib
+import io
+import math
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from archive_folders import folder_week_start
+from imap_fetch import fetch_voicemails, parse_fetch, uid_set, walk_parts
+from segmenter import split_pcm, stitch_transcripts
+
+class ReplayIMAP(imaplib.IMAP4):
+    """Answers each command with the next recorded response; {tag} is replaced by the command's tag."""
+    def __init__(self, *responses):
+        self.responses = [b'* OK [CAPABILITY IMAP4rev1] ready\r\n',
+                          b'* CAPABILITY IMAP4rev1 IDLE\r\n{tag} OK done\r\n'] + list(responses)
+        self.commands = []
+        super().__init__()
+        self.state = 'SELECTED'
+
+    def open(self, host='', port=imaplib.IMAP4_PORT, timeout=None):
+        self.host, self.port = host, port
+        self.file = io.BytesIO(self.responses.pop(0))
+
+    def send(self, data):
+        tag, command = data.split(b' ', 1)
+        self.commands.append(command.strip().decode())
+        self.file = io.BytesIO(self.responses.pop(0).replace(b'{tag}', tag))
+
+    def shutdown(self):
+        pass
+
+def literal(data):
+    return b'{%d}\r\n' % len(data) + data
+
+WAV = b'RIFF\x24\x00\x00\x00WAVEfmt ' + bytes(28)
+WAV_BASE64 = base64.encodebytes(WAV)
+TEXT_QP = b'Voicemail van 0612345678 om 09:12 voor wachtrij 2, duur 0:42.=0D=0ABel terug =\r\na.u.b.'
+HEADERS = b'Subject: PBX voicemail van 0612345678\r\nFrom: PBX <pbx@example.nl>\r\n\r\n'
+
+def parts_response(uid, sections):
+    items = b' '.join(b'BODY[%s] ' % section.encode() + literal(body) for section, body in sections)
+    return b'* 1 FETCH (UID %d ' % uid + items + b')\r\n{tag} OK Fetch completed.\r\n'
+
+# Dovecot: lower case, multipart/alternative inside multipart/mixed, header fields as a literal
+DOVECOT_STRUCTURE = (
+    b'* 1 FETCH (UID 5 INTERNALDATE "17-Oct-2026 09:12:01 +0200" BODYSTRUCTURE ((('
+    b'"text" "plain" ("charset" "utf-8") NIL NIL "quoted-printable" 87 2 NIL NIL NIL NIL)('
+    b'"text" "html" ("charset" "utf-8") NIL NIL "quoted-printable" 140 4 NIL NIL NIL NIL) '
+    b'"alternative" ("boundary" "alt") NIL NIL NIL)('
+    b'"audio" "x-wav" ("name" "msg0001.wav") NIL NIL "base64" 62 NIL ("attachment" ("filename" "msg0001.wav")) '
+    b'NIL NIL) "mixed" ("boundary" "mix") NIL NIL NIL) BODY[HEADER.FIELDS (SUBJECT FROM)] ' + literal(HEADERS) + b')\r\n'
+    b'{tag} OK Fetch completed (0.001 + 0.000 secs).\r\n'
+)
+
+# Gmail: upper case, an RFC 2047 file name, header fields quoted as they were sent
+GMAIL_STRUCTURE = (
+    b'* 12 FETCH (UID 4821 INTERNALDATE "17-Oct-2026 07:12:01 +0000" BODYSTRUCTURE (('
+    b'"TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 87 2 NIL NIL NIL)('
+    b'"AUDIO" "X-WAV" ("NAME" "=?UTF-8?Q?Bericht_van_J=C3=BCrgen.wav?=") NIL NIL "BASE64" 62 NIL '
+    b'("ATTACHMENT" ("FILENAME" "=?UTF-8?Q?Bericht_van_J=C3=BCrgen.wav?=")) NIL) "MIXED" ("BOUNDARY" "000000") NIL NIL) '
+    b'BODY[HEADER.FIELDS ("SUBJECT" "FROM")] ' + literal(HEADERS) + b')\r\n'
+    b'{tag} OK Success\r\n'
+)
+
+def test_dovecot_nested_multipart():
+    mail = ReplayIMAP(DOVECOT_STRUCTURE, parts_response(5, [('1.1', TEXT_QP), ('2', WAV_BASE64)]))
+    voicemails = fetch_voicemails(mail, [5])
+    assert mail.commands[-1] == 'UID FETCH 5 (UID BODY.PEEK[1.1] BODY.PEEK[2])'
+    voicemail = voicemails[5]
+    assert voicemail.subject == 'PBX voicemail van 0612345678'
+    assert voicemail.sender == 'PBX <pbx@example.nl>'
+    assert voicemail.text.startswith('Voicemail van 0612345678') and voicemail.text.endswith('Bel terug a.u.b.')
+    assert voicemail.attachments == [('msg0001.wav', WAV)]
+    assert voicemail.received == datetime(2026, 10, 17, 7, 12, 1, tzinfo=timezone.utc).timestamp()
+
+def test_gmail_encoded_file_name_and_quoted_header_fields():
+    mail = ReplayIMAP(GMAIL_STRUCTURE, parts_response(4821, [('1', TEXT_QP), ('2', WAV_BASE64)]))
+    voicemail = fetch_voicemails(mail, [4821])[4821]
+    assert voicemail.subject == 'PBX voicemail van 0612345678'
+    assert voicemail.attachments == [('Bericht van Jürgen.wav', WAV)]
+
+def test_file_name_sent_as_literal():
+    name = 'Bericht van Jürgen "Jos".wav'.encode()
+    structure = (
+        b'* 2 FETCH (UID 6 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 10 1 NIL NIL NIL NIL)('
+        b'"audio" "wav" ("name" ' + literal(name) + b') NIL NIL "base64" 62 NIL ("attachment" ("filename" '
+        + literal(name) + b')) NIL NIL) "mixed" ("boundary" "b") NIL NIL NIL) '
+        b'BODY[HEADER.FIELDS (SUBJECT FROM)] ' + literal(HEADERS) + b')\r\n{tag} OK done\r\n'
+    )
+    mail = ReplayIMAP(structure, parts_response(6, [('1', b'Bel terug'), ('2', WAV_BASE64)]))
+    voicemail = fetch_voicemails(mail, [6])[6]
+    assert voicemail.text == 'Bel terug'
+    assert voicemail.attachments == [('Bericht van Jürgen "Jos".wav', WAV)]
+
+def test_rfc2231_file_name():
+    structure = (b'("audio" "x-wav" NIL NIL NIL "base64" 62 NIL '
+                 b'("attachment" ("filename*" "utf-8\'\'Bericht%20van%20J%C3%BCrgen.wav")) NIL NIL)')
+    parts = list(walk_parts(parse_fetch([b'1 (UID 1 BODYSTRUCTURE ' + structure + b')'])[1]['BODYSTRUCTURE']))
+    assert [(part.section, part.name) for part in parts] == [('1', 'Bericht van Jürgen.wav')]
+
+def test_header_field_echo_variants():
+    for echo in (b'BODY[HEADER.FIELDS (SUBJECT FROM)]', b'BODY[HEADER.FIELDS ("SUBJECT" "FROM")]',
+                 b'body[header.fields (subject from)]'):
+        structure = (b'* 1 FETCH (BODYSTRUCTURE ("text" "plain" ("charset" "us-ascii") NIL NIL "7bit" 9 1 NIL NIL NIL) '
+                     + echo + b' ' + literal(HEADERS) + b' UID 8)\r\n{tag} OK done\r\n')
+        mail = ReplayIMAP(structure, parts_response(8, [('1', b'geen audio')]))
+        voicemail = fetch_voicemails(mail, [8])[8]
+        assert voicemail.subject == 'PBX voicemail van 0612345678', echo
+        assert (voicemail.text, voicemail.attachments) == ('geen audio', [])
+
+def test_unsolicited_fetch_for_other_mail_is_ignored():
+    unsolicited = b'* 3 FETCH (UID 77 MODSEQ (12345) FLAGS (\\Seen))\r\n* 4 FETCH (FLAGS (\\Deleted))\r\n'
+    structure = unsolicited + DOVECOT_STRUCTURE
+    parts = unsolicited + parts_response(5, [('1.1', TEXT_QP), ('2', WAV_BASE64)])
+    voicemails = fetch_voicemails(ReplayIMAP(structure, parts), [5, 9])
+    # 9 is gone, 77 was not asked for
+    assert list(voicemails) == [5]
+    assert voicemails[5].attachments == [('msg0001.wav', WAV)]
+
+def test_uid_set():
+    assert uid_set([]) == ''
+    assert uid_set([7]) == '7'
+    assert uid_set([1, 2, 3, 5, 8, 9]) == '1:3,5,8:9'
+
+def test_folder_week_start():
+    assert folder_week_start(2026, 42) == date(2026, 10, 12)
+    # Named with the calendar year on 29-31 December, in ISO week 1 of the next year
+    assert folder_week_start(2025, 1) == date(2025, 12, 29)
+    # Named with the calendar year on 1-3 January, in the last ISO week of the year before
+    assert folder_week_start(2027, 53) == date(2026, 12, 28)
+    assert folder_week_start(2030, 60) is None
+
+RATE = 8000
+
+def tone(ms, amplitude=8000):
+    return array('h', (int(amplitude * math.sin(2 * math.pi * 440 * i / RATE)) for i in range(ms * RATE // 1000)))
+
+def silence(ms):
+    return array('h', bytes(ms * RATE // 1000 * 2))
+
+def pcm(*pieces):
+    samples = array('h')
+    for piece in pieces:
+        samples.extend(piece)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+def split(audio):
+    return split_pcm(audio, RATE, max_ms=1000, search_ms=400, window_ms=50, overlap_ms=200)
+
+def test_split_pcm_silence_only():
+    assert split(pcm(silence(3000))) == []
+
+def test_split_pcm_trims_silence():
+    segments = split(pcm(silence(1000), tone(300), silence(1000)))
+    assert len(segments) == 1
+    # Trimmed to the sound, with 250 ms padding on either side
+    assert 700 <= segments[0].start_ms <= 750 and 1300 <= segments[0].end_ms <= 1600
+    assert not segments[0].overlapped
+
+def test_split_pcm_cuts_in_silence():
+    segments = split(pcm(tone(800), silence(100), tone(800)))
+    assert len(segments) == 2
+    assert 800 <= segments[0].end_ms <= 900 and segments[1].start_ms == segments[0].end_ms
+    assert not any(segment.overlapped for segment in segments)
+
+def test_split_pcm_overlaps_cuts_in_speech():
+    audio = pcm(tone(2500))
+    segments = split(audio)
+    assert len(segments) == 3
+    assert all(segment.end_ms - segment.start_ms <= 1000 for segment in segments)
+    assert [segment.overlapped for segment in segments] == [False, True, True]
+    for before, after in zip(segments, segments[1:]):
+        assert after.start_ms == before.end_ms - 200
+    assert segments[0].pcm == audio[:len(segments[0].pcm)]
+
+def test_stitch_transcripts():
+    assert stitch_transcripts(["bel me terug", "op nummer twee"], [False, False]) == "bel me terug op nummer twee"
+    # The words both overlapping segments heard are kept once, whatever the case and punctuation
+    assert stitch_transcripts(["bel me terug op", "Terug, op nummer twee"], [False, True]) == \
+        "bel me terug op nummer twee"
+    # Without overlap nothing is dropped, even when the words repeat
+    assert stitch_transcripts(["ja ja", "ja ja"], [False, False]) == "ja ja ja ja"
+    assert stitch_transcripts(["", "hallo"], [False, True]) == "hallo"
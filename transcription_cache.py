@@ -0,0 +1,64 @@
+"""
+On-disk cache of transcripts, keyed by the audio and the recognition settings.
+
+A voicemail that is processed again (after a failed send or a restart) or that the PBX
+sends twice is then not transcribed, and paid for, a second time.
+"""
+import hashlib
+import logging
+import sqlite3
+import time
+
+class TranscriptionCache:
+    def __init__(self, path, max_entries=10000, max_age_days=30):
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            " key TEXT PRIMARY KEY,"
+            " transcript TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS transcripts_used ON transcripts (used)")
+        self.db.commit()
+        self.evict()
+
+    @staticmethod
+    def key(pcm, language_code, sample_rate):
+        digest = hashlib.sha256(f"{language_code}:{sample_rate}:".encode())
+        digest.update(pcm)
+        return digest.hexdigest()
+
+    def get(self, key):
+        row = self.db.execute("SELECT transcript FROM transcripts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE transcripts SET used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        logging.info(f"Transcription cache hit ({self.hits} hits, {self.misses} misses)")
+        return row[0]
+
+    def put(self, key, transcript):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO transcripts (key, transcript, created, used) VALUES (?, ?, ?, ?)",
+            (key, transcript, now, now),
+        )
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        """Drop entries not used within max_age, then the least recently used above max_entries."""
+        self.db.execute("DELETE FROM transcripts WHERE used < ?", (time.time() - self.max_age,))
+        self.db.execute(
+            "DELETE FROM transcripts WHERE key IN ("
+            " SELECT key FROM transcripts ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.db.commit()